@@ -0,0 +1,100 @@
+"""Configuration shared by every service, read from config.toml and overridden by environment variables
+
+The environment variable names are those the services used before, so a docker-compose file can
+still change a setting for one service. The hash of the settings that change the results (analysis,
+samples, binning and the consumers' engines) is stamped into every task, and the consumers refuse
+tasks with another hash.
+"""
+
+import hashlib
+import json
+import os
+import tomllib
+
+# File holding the configuration, config.toml next to this module unless PIPELINE_CONFIG is set
+config_path = os.getenv('PIPELINE_CONFIG') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.toml')
+
+# Environment variable overriding each setting, PREFETCH_COUNT and MAX_RETRIES are set per service
+env_overrides = {
+    'LUMI': [('analysis', 'lumi')],
+    'FRACTION': [('analysis', 'fraction')],
+    'TUPLE_PATH': [('analysis', 'tuple_path')],
+    'RABBITMQ_HOST': [('broker', 'host')],
+    'ENTRIES_PER_TASK': [('producer', 'entries_per_task')],
+    'PUBLISH_WINDOW': [('producer', 'publish_window')],
+    'FILE_INDEX': [('producer', 'file_index')],
+    'CONSUMER_MODE': [('consumer', 'mode')],
+    'STREAM_BATCHES': [('consumer', 'stream_batches')],
+    'MASS_ENGINE': [('consumer', 'mass_engine')],
+    'CHECK_MASS': [('consumer', 'check_mass')],
+    'WEIGHT_ENGINE': [('consumer', 'weight_engine')],
+    'EVENT_ENGINE': [('consumer', 'event_engine')],
+    'WORKER_PROCESSES': [('consumer', 'worker_processes')],
+    'HEARTBEAT': [('consumer', 'heartbeat')],
+    'ITERATE_STEP': [('consumer', 'iterate_step')],
+    'ADAPTIVE_STEP': [('consumer', 'adaptive_step')],
+    'TARGET_BATCH_SECONDS': [('consumer', 'target_batch_seconds')],
+    'MEMORY_LIMIT_MB': [('consumer', 'memory_limit_mb')],
+    'LOG_BATCHES': [('consumer', 'log_batches')],
+    'PREFETCH_DEPTH': [('consumer', 'prefetch_depth')],
+    'PREFETCH_COUNT': [('consumer', 'prefetch_count'), ('outputter', 'prefetch_count')],
+    'MAX_RETRIES': [('consumer', 'max_retries'), ('outputter', 'max_retries')],
+    'RUN_TIMEOUT': [('outputter', 'run_timeout')],
+    'OUTPUT_DIR': [('outputter', 'output_dir')],
+    'FILE_CACHE_DIR': [('cache', 'file_cache_dir')],
+    'FILE_CACHE_MAX_GB': [('cache', 'file_cache_max_gb')],
+    'BASKET_CACHE_MB': [('cache', 'basket_cache_mb')],
+    'BASKET_CACHE_DIR': [('cache', 'basket_cache_dir')],
+    'BASKET_CACHE_MAX_GB': [('cache', 'basket_cache_max_gb')],
+    'SKIM_DIR': [('cache', 'skim_dir')],
+    'LEDGER_DIR': [('cache', 'ledger_dir')],
+}
+
+# Sections that change the results of a run, and so the config hash
+result_sections = ['analysis', 'samples', 'binning']
+# Settings of the consumers that change the results, also in the config hash
+result_settings = {'consumer': ['mass_engine', 'weight_engine', 'event_engine']}
+
+
+### Convert an environment variable to the type of the setting it overrides
+def convert(value, default):
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes')
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+### Read the configuration file and apply the environment variables
+def load(path=config_path, environ=os.environ):
+    with open(path, 'rb') as f:
+        settings = tomllib.load(f)
+    for name, keys in env_overrides.items():
+        if name in environ:
+            for section, key in keys:
+                settings[section][key] = convert(environ[name], settings[section].get(key))
+    return settings
+
+
+### Hash of the settings that change the results
+def config_hash(settings):
+    key = {section: settings[section] for section in result_sections}
+    for section, keys in result_settings.items():
+        key[section] = {k: settings[section][k] for k in keys}
+    key = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+settings = load()
+config_id = config_hash(settings)
+
+### Units ###
+MeV = 0.001
+GeV = 1.0
+
+lumi = settings['analysis']['lumi'] # fb-1
+fraction = settings['analysis']['fraction']
+tuple_path = settings['analysis']['tuple_path']
+samples = settings['samples']
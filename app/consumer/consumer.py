@@ -4,51 +4,82 @@ import awkward as ak
 import vector
 import time
 import json
-import infofile
+import os
+import sys
+import functools
+import multiprocessing # start method of the worker processes
+import concurrent.futures # for the processing thread and the worker processes
+from concurrent.futures.process import BrokenProcessPool
+import queue # for the batch prefetching thread
+import threading
+import infostore
+import filecache # local on-disk cache of the remote files
+import httpcache # byte-range cache for reading remote files
+import wire # columnar message format
+from histogram import Histogram # mergeable histogram
+import fastloop # numba-compiled event loop
+import skimstore # Parquet store of the events passing the selection
+from selection import (cut_lep_charge, cut_lep_type, cut_branches, kinematic_branches,
+                       weight_branches, selection_hash) # event selection shared with the producer
 import numpy as np
-import zlib
 
-### Units ###
-MeV = 0.001
-GeV = 1.0
-# url for data
-tuple_path = "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/" # web address
-#lumi = 0.5 # fb-1 # data_A only
-#lumi = 1.9 # fb-1 # data_B only
-#lumi = 2.9 # fb-1 # data_C only
-#lumi = 4.7 # fb-1 # data_D only
-lumi = 10 # fb-1 # data_A,data_B,data_C,data_D
-fraction = 1.0 # reduce this is if you want the code to run quicker
-
-
-samples = {
-
-    'data': {
-        'list' : ['data_A','data_B','data_C','data_D'],
-    },
-
-    r'Background $Z,t\bar{t}$' : { # Z + ttbar
-        'list' : ['Zee','Zmumu','ttbar_lep'],
-        'color' : "#6b59d3" # purple
-    },
-
-    r'Background $ZZ^*$' : { # ZZ
-        'list' : ['llll'],
-        'color' : "#ff0000" # red
-    },
-
-    r'Signal ($m_H$ = 125 GeV)' : { # H -> ZZ -> llll
-        'list' : ['ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep'],
-        'color' : "#00cdff" # light blue
-    },
-
-}
+from config import settings, config_id, lumi, MeV, GeV, tuple_path # shared pipeline configuration
+
+consumer_settings = settings['consumer']
+# send events ('events') or binned histograms of the 4-lepton invariant mass ('histogram') to the outputter
+consumer_mode = consumer_settings['mode']
+# send each batch of events to the outputter as soon as it is processed, instead of one message per task
+stream_batches = consumer_settings['stream_batches']
+# calculate the 4-lepton invariant mass with 'vector' or with the fused 'numpy' kernel
+mass_engine = consumer_settings['mass_engine']
+# check the numpy kernel against vector on every batch
+check_mass = consumer_settings['check_mass']
+# multiply the Monte Carlo weights with 'awkward' arrays or in place into one 'numpy' array
+weight_engine = consumer_settings['weight_engine']
+# process events with 'awkward' arrays or with the compiled 'numba' event loop (histogram mode only)
+event_engine = consumer_settings['event_engine']
+if event_engine == 'numba' and not fastloop.available:
+    print('Numba is not installed, using the awkward engine')
+    event_engine = 'awkward'
+if event_engine == 'numba' and consumer_mode != 'histogram':
+    print('The numba engine only fills histograms, using the awkward engine')
+    event_engine = 'awkward'
+# number of worker processes running process_segment, 'auto' for one per core, 1 runs tasks in this process
+worker_processes = str(consumer_settings['worker_processes'])
+worker_processes = os.cpu_count() if worker_processes == 'auto' else int(worker_processes)
+# number of unacknowledged tasks the broker gives to each worker at a time
+prefetch_count = consumer_settings['prefetch_count']
+# number of times a failed task is put back in the queue before it is dropped
+max_retries = consumer_settings['max_retries']
+# seconds between heartbeats with the broker, tasks run off the connection's thread so they keep being sent
+heartbeat = consumer_settings['heartbeat']
+# size of each batch read from a file: a number of entries, or bytes as a string such as "100 MB"
+iterate_step = consumer_settings['iterate_step']
+if isinstance(iterate_step, str) and iterate_step.isdigit(): # a number of entries set from the environment
+    iterate_step = int(iterate_step)
+# change the number of entries per batch to aim at target_batch_seconds per batch and stay under memory_limit
+adaptive_step = consumer_settings['adaptive_step']
+target_batch_seconds = float(consumer_settings['target_batch_seconds'])
+memory_limit = consumer_settings['memory_limit_mb'] * 1e6 # resident memory of a worker in bytes
+min_step, max_step = 1000, 10000000 # limits of the adaptive number of entries per batch
+# print the timing and memory of every batch
+log_batches = consumer_settings['log_batches']
+# number of batches read ahead in a background thread while the current batch is processed, 0 turns it off
+prefetch_depth = consumer_settings['prefetch_depth']
+# hash of the selection, the skims written by this consumer are stored under it
+selection_id = selection_hash(settings)
+
+### Histogram binning, the same as used by plot_data in the outputter
+xmin = settings['binning']['xmin'] * GeV
+xmax = settings['binning']['xmax'] * GeV
+step_size = settings['binning']['step_size'] * GeV
+bin_edges = np.arange(start=xmin, stop=xmax+step_size, step=step_size)
 
 # Connect to RabbitMQ
 def rabbitmq_connect(host, retries=10, delay=5):
     for i in range (retries):
         try:
-            return pika.BlockingConnection(pika.ConnectionParameters(host=host))
+            return pika.BlockingConnection(pika.ConnectionParameters(host=host, heartbeat=heartbeat))
         except pika.exceptions.AMQPConnectionError:
             print(f'Failed to connect to {host}, retrying in {delay} seconds')
             time.sleep(delay)
@@ -69,13 +100,29 @@ def calc_weight(xsec_weight, events):
 
 
 ### Get cross section of weight
-
+# constant for each sample, so only calculated once per process
+@functools.lru_cache(maxsize=None)
 def get_xsec_weight(sample):
-    info = infofile.infos[sample] # open infofile
+    info = infostore.infos[sample] # look up in the metadata table
     xsec_weight = (lumi*1000*info["xsec"])/(info["sumw"]*info["red_eff"]) #*1000 to go from fb-1 to pb-1
     return xsec_weight # return cross-section weight
 
 
+### Calculate weight of MC events with numpy
+# the cross-section weight and every scale factor are multiplied in place into one float64 array,
+# instead of creating a new array for each product
+def calc_weight_numpy(xsec_weight, events):
+    total = np.multiply(ak.to_numpy(events[weight_branches[0]]), xsec_weight, dtype=np.float64)
+    for name in weight_branches[1:]:
+        np.multiply(total, ak.to_numpy(events[name]), out=total)
+    return total
+
+### Calculate weight of MC events with the engine chosen by weight_engine
+def calc_weight_engine(xsec_weight, events):
+    if weight_engine == 'numpy':
+        return calc_weight_numpy(xsec_weight, events)
+    return calc_weight(xsec_weight, events)
+
 ### Calculate 4-lepton invariate mass
 def calc_mllll(lep_pt, lep_eta, lep_phi, lep_E):
     # construct awkward 4-vector array
@@ -85,89 +132,351 @@ def calc_mllll(lep_pt, lep_eta, lep_phi, lep_E):
     # .M calculates the invariant mass
     return (p4[:, 0] + p4[:, 1] + p4[:, 2] + p4[:, 3]).M * MeV
 
-# cut on lepton charge
-# paper: "selecting two pairs of isolated leptons, each of which is comprised of two leptons with the same flavour and opposite charge"
-def cut_lep_charge(lep_charge):
-# throw away when sum of lepton charges is not equal to 0
-# first lepton in each event is [:, 0], 2nd lepton is [:, 1] etc
-    return lep_charge[:, 0] + lep_charge[:, 1] + lep_charge[:, 2] + lep_charge[:, 3] != 0
-
-# cut on lepton type
-# paper: "selecting two pairs of isolated leptons, each of which is comprised of two leptons with the same flavour and opposite charge"
-def cut_lep_type(lep_type):
-# for an electron lep_type is 11
-# for a muon lep_type is 13
-# throw away when none of eeee, mumumumu, eemumu
-    sum_lep_type = lep_type[:, 0] + lep_type[:, 1] + lep_type[:, 2] + lep_type[:, 3]
-    return (sum_lep_type != 44) & (sum_lep_type != 48) & (sum_lep_type != 52)
+### Index of the first 4 leptons of each event in the flattened lepton arrays, shape (events, 4)
+def first_four_index(leptons):
+    counts = ak.to_numpy(ak.num(leptons))
+    starts = np.cumsum(counts) - counts # index of the first lepton of each event
+    return starts[:, None] + np.arange(4)
+
+### Get the first 4 leptons of each event as an (events, 4) numpy array
+def first_four(leptons, index):
+    return ak.to_numpy(ak.flatten(leptons))[index].astype(np.float64)
+
+### Calculate 4-lepton invariant mass with numpy
+# converts pt, eta, phi to px, py, pz, sums the first 4 leptons and calculates M into
+# preallocated arrays, without building 4-vector records
+def calc_mllll_numpy(lep_pt, lep_eta, lep_phi, lep_E):
+    index = first_four_index(lep_pt) # the same for all lepton variables
+    pt = first_four(lep_pt, index)
+    eta = first_four(lep_eta, index)
+    phi = first_four(lep_phi, index)
+    n = len(pt)
+    tmp = np.empty((n, 4)) # per lepton component
+    px, py, pz, E = np.empty(n), np.empty(n), np.empty(n), np.empty(n) # sums over the 4 leptons
+    np.multiply(pt, np.cos(phi, out=tmp), out=tmp)
+    tmp.sum(axis=1, out=px)
+    np.multiply(pt, np.sin(phi, out=tmp), out=tmp)
+    tmp.sum(axis=1, out=py)
+    np.multiply(pt, np.sinh(eta, out=tmp), out=tmp)
+    tmp.sum(axis=1, out=pz)
+    first_four(lep_E, index).sum(axis=1, out=E)
+    # M^2 = E^2 - p^2, negative values from rounding give a negative mass like vector
+    np.multiply(E, E, out=E)
+    E -= np.multiply(px, px, out=px)
+    E -= np.multiply(py, py, out=py)
+    E -= np.multiply(pz, pz, out=pz)
+    mass = np.copysign(np.sqrt(np.abs(E, out=px), out=px), E, out=px)
+    mass *= MeV
+    return mass
+
+### Calculate 4-lepton invariant mass with the engine chosen by mass_engine
+def calc_mllll_engine(lep_pt, lep_eta, lep_phi, lep_E):
+    if mass_engine != 'numpy':
+        return calc_mllll(lep_pt, lep_eta, lep_phi, lep_E)
+    mass = calc_mllll_numpy(lep_pt, lep_eta, lep_phi, lep_E)
+    if check_mass: # compare with the vector implementation, only reported as it is a diagnostic
+        print(f'numpy mass differs from vector by up to {mass_difference(mass, lep_pt, lep_eta, lep_phi, lep_E)}')
+    return mass
+
+### Largest absolute and relative difference between a mass calculated with numpy and with vector
+# vector calculates in the float32 of the lepton branches, so masses close to 0 can differ by a few MeV
+def mass_difference(mass, lep_pt, lep_eta, lep_phi, lep_E):
+    if len(mass) == 0:
+        return '0 GeV'
+    expected = ak.to_numpy(calc_mllll(lep_pt, lep_eta, lep_phi, lep_E)).astype(np.float64)
+    difference = np.abs(mass - expected)
+    relative = difference / np.maximum(np.abs(expected), 1.0) # relative to 1 GeV for masses close to 0
+    return f'{np.max(difference):.2e} GeV ({np.max(relative):.1e} relative)'
+
+### Entry ranges of the baskets holding the passing entries, neighbouring baskets are joined
+# entries are counted from the start of the batch
+def passing_ranges(passing, basket_offsets, batch_start):
+    baskets = np.unique(np.searchsorted(basket_offsets, batch_start + passing, side='right') - 1)
+    ranges = []
+    for basket in baskets:
+        start = int(max(basket_offsets[basket] - batch_start, passing[0]))
+        stop = int(min(basket_offsets[basket + 1] - batch_start, passing[-1] + 1))
+        if ranges and ranges[-1][1] == start: # continues the previous range
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+### Read a batch in two stages: the cut branches for the whole batch, then the other branches
+# only for the baskets that have events passing the cuts
+def read_passing_events(tree, cut_data, batch_start, bytes_read, branches):
+    # cut on lepton charge and lepton type using the functions defined above
+    mask = ~cut_lep_charge(cut_data.lep_charge) & ~cut_lep_type(cut_data.lep_type)
+    passing = np.flatnonzero(ak.to_numpy(mask))
+    if len(passing) == 0: # nothing passes, the other branches are never read
+        return None
+
+    source = tree.file.source
+    before = source.num_requested_bytes
+    data_all = []
+    for start, stop in passing_ranges(passing, tree[kinematic_branches[0]].entry_offsets, batch_start):
+        data = tree.arrays(branches,
+                           library="ak", # choose output type as awkward array
+                           entry_start=batch_start + start,
+                           entry_stop=batch_start + stop) # only the baskets with passing entries
+        range_mask = mask[start:stop]
+        data = data[range_mask]
+        data['lep_charge'] = cut_data.lep_charge[start:stop][range_mask]
+        data['lep_type'] = cut_data.lep_type[start:stop][range_mask]
+        data_all.append(data)
+    bytes_read['other'] += source.num_requested_bytes - before
+    return data_all[0] if len(data_all) == 1 else ak.concatenate(data_all)
+
+### Resident memory of this process in bytes, None where /proc is not available
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+### Number of entries in the next batch: halve it above the memory limit or when a batch takes much
+# longer than the target time, double it when batches are much quicker than the target
+def next_step(step, batch_time, rss):
+    if rss is not None and rss > memory_limit:
+        return max(min_step, step // 2)
+    if batch_time > 2 * target_batch_seconds:
+        return max(min_step, step // 2)
+    if batch_time < target_batch_seconds / 2 and (rss is None or rss < 0.8 * memory_limit):
+        return min(max_step, step * 2)
+    return step
+
+### Read batches of state['step'] entries, each ending on a basket boundary of the first branch
+# so that no basket is decompressed for two batches
+def adaptive_reader(tree, branches, entry_start, entry_stop, state):
+    basket_offsets = tree[branches[0]].entry_offsets
+    batch_start = entry_start
+    while batch_start < entry_stop:
+        i = np.searchsorted(basket_offsets, batch_start + state['step']) # first boundary at or after the target
+        batch_stop = min(int(basket_offsets[i]) if i < len(basket_offsets) else entry_stop, entry_stop)
+        yield tree.arrays(branches, library="ak", entry_start=batch_start, entry_stop=batch_stop), batch_start
+        batch_start = batch_stop
+
+### Read batches in a background thread, up to depth batches ahead of the caller
+# stalls adds up the time the caller waits for a batch (waiting on I/O) and the time the reader
+# waits for space in the queue (waiting on processing)
+def prefetch(reader, depth, stalls):
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event() # set when the caller stops, e.g. after an error
+
+    def put(item): # wait for space in the queue unless the caller has stopped
+        start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stalls['reader'] += time.perf_counter() - start
+
+    def read():
+        try:
+            for batch in reader:
+                put(('batch', batch))
+                if stop.is_set():
+                    return
+            put(('end', None))
+        except Exception as e: # raised again in the caller
+            put(('error', e))
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            kind, item = batches.get()
+            stalls['caller'] += time.perf_counter() - start
+            if kind == 'end':
+                return
+            if kind == 'error':
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join() # the file must not be closed while a batch is being read
+
+### Batches of an entry range as (awkward array, first entry of the batch), read with iterate_step
+# or with the adaptive step, logging the read and processing time and memory of each batch
+# load(data, batch_start) is called on each batch by the reader, e.g. to read the other branches of the
+# passing events, so with prefetch_depth all of the reading runs in the background thread and
+# overlaps the processing
+# read_branches are all the branches read for a batch, including those read by load, and a byte
+# iterate_step is the size of a batch of all of them
+def iterate_batches(tree, branches, entry_start, entry_stop, load=None, read_branches=None):
+    step = iterate_step
+    if isinstance(step, str): # number of entries in iterate_step bytes
+        step = tree.num_entries_for(step, read_branches or branches, entry_start=entry_start, entry_stop=entry_stop)
+    if adaptive_step:
+        state = {'step': max(min_step, min(max_step, int(step)))}
+        reader = adaptive_reader(tree, branches, entry_start, entry_stop, state)
+    else:
+        reader = ((data, report.tree_entry_start) for data, report in
+                  tree.iterate(branches, library="ak", step_size=step,
+                               entry_start=entry_start, entry_stop=entry_stop, report=True))
+    load = load or (lambda data, batch_start: data)
+    reader = ((load(data, batch_start), batch_start, len(data)) for data, batch_start in reader)
+    stalls = {'caller': 0.0, 'reader': 0.0}
+    if prefetch_depth > 0:
+        reader = prefetch(reader, prefetch_depth, stalls)
+    try:
+        while True:
+            start = time.perf_counter()
+            batch = next(reader, None)
+            if batch is None:
+                break
+            read_time = time.perf_counter() - start # only the wait for the batch when prefetching
+            data, batch_start, num_entries = batch
+            yield data, batch_start # processed by the caller before the loop continues
+            batch_time = time.perf_counter() - start
+            rss = rss_bytes()
+            if log_batches:
+                print(f"Batch of {num_entries} entries from {batch_start}: waited {read_time:.3f} s for it, "
+                      f"processed {batch_time - read_time:.3f} s, RSS {(rss or 0)/1e6:.0f} MB")
+            if adaptive_step:
+                state['step'] = next_step(state['step'], batch_time, rss)
+    finally:
+        reader.close() # stops the prefetching thread if the caller stopped early
+    if prefetch_depth > 0:
+        print(f"Prefetching: waited {stalls['caller']:.3f} s for batches, "
+              f"the reader waited {stalls['reader']:.3f} s for them to be processed")
+
+### Add a batch of events to the histogram of the 4-lepton invariant mass
+def fill_mllll(hist, data):
+    if 'totalWeight' in data.fields: # Monte Carlo
+        return hist.fill(ak.to_numpy(data['mllll']), ak.to_numpy(data['totalWeight']))
+    return hist.fill(ak.to_numpy(data['mllll'])) # data events are not weighted
 
 ### Function to process data
+# yields the messages to send to the outputter, the last one of each task has end_of_task set
 def process_segment(field_list, tuple_path):
-    field = field_list.decode('utf-8')
-    pref = field.split()[0]
-    val = field.split()[1]
+    task = json.loads(field_list.decode('utf-8'))
+    if task.get('config', config_id) != config_id: # put back in the queue for a consumer with the same configuration
+        raise ValueError(f"Task {task['task_id']} was made with configuration {task['config']}, this consumer has {config_id}")
+    pref = task['prefix']
+    val = task['sample']
     sample = val
     fileString = tuple_path+pref+val+".4lep.root" # file name to open
+    fileString = filecache.fetch(fileString) # use the local copy if the file is cached
     
     data_all = [] # empty list to hold data
+    # write the events passing the selection to a skim batch by batch, the numba engine does not make them
+    # the skim is stored under the version of the input file the producer found, none is written without it
+    skim = skimstore.Writer(selection_id, sample, task['entry_start'], task['entry_stop'], task.get('source'),
+                            enabled=skimstore.enabled and event_engine != 'numba')
+    hist = Histogram(bin_edges) # histogram filled batch by batch in histogram mode
+    header = {'sample': sample, 'run_id': task.get('run_id'), 'run_created': task.get('run_created'),
+              'task_id': task['task_id'],
+              # time this attempt at the task started, the outputter only keeps the messages of the latest
+              # attempt as a retried task can split its entries into different batches
+              'attempt': time.time(),
+              'fingerprint': task.get('fingerprint')} # the outputter records it in the run ledger
+    seq = 0 # sequence number of the messages sent for this task
+
+    # read remote files through the byte-range cache
+    options = {'handler': httpcache.CachingHTTPSource} if fileString.startswith('http') else {}
+    httpcache.reset_stats()
 
     start = time.time() # start timer
     # open the tree called mini using a context manager (will automatically close files/resources)
-    with uproot.open(fileString + ":mini") as tree:
-        numevents = tree.num_entries # number of events
+    with uproot.open(fileString + ":mini", **options) as tree, skim: # the skim is completed with the task
         if 'data' not in sample: xsec_weight = get_xsec_weight(sample) # get cross-section weight
-        for data in tree.iterate(['lep_pt','lep_eta','lep_phi',
-                                  'lep_E','lep_charge','lep_type', 
-                                  # add more variables here if you make cuts on them 
-                                  'mcWeight','scaleFactor_PILEUP',
-                                  'scaleFactor_ELE','scaleFactor_MUON',
-                                  'scaleFactor_LepTRIGGER'], # variables to calculate Monte Carlo weight
-                                 library="ak", # choose output type as awkward array
-                                 entry_stop=numevents*fraction): # process up to numevents*fraction
-            if 'data' not in sample: # only do this for Monte Carlo simulation files
-                # multiply all Monte Carlo weights and scale factors together to give total weight
-                data['totalWeight'] = calc_weight(xsec_weight, data)
-
-            # cut on lepton charge using the function cut_lep_charge defined above
-            data = data[~cut_lep_charge(data.lep_charge)]
-
-            # cut on lepton type using the function cut_lep_type defined above
-            data = data[~cut_lep_type(data.lep_type)]
-
-            # calculation of 4-lepton invariant mass using the function calc_mllll defined above
-            data['mllll'] = calc_mllll(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
-
-            # array contents can be printed at any stage like this
-            #print(data)
-
-            # array column can be printed at any stage like this
-            #print(data['lep_pt'])
-
-            # multiple array columns can be printed at any stage like this
-            #print(data[['lep_pt','lep_eta']])
-
+        # data events are not weighted, so their weight branches are never read
+        other_branches = kinematic_branches + (weight_branches if 'data' not in sample else [])
+        bytes_read = {'cuts': 0, 'other': 0} # bytes requested from the file by each stage
+        source = tree.file.source
+        before = source.num_requested_bytes
+        if event_engine == 'numba': # cuts, weights, mass and histogram in one compiled loop
+            for data, _ in iterate_batches(tree, cut_branches + other_branches,
+                                           task['entry_start'], task['entry_stop']): # this task's entry range
+                fastloop.fill(hist, data, weight_branches, xsec_weight if 'data' not in sample else None)
+        else:
+            # both stages are read by the reader, the loop gets the passing events of each batch
+            read_other = lambda cut_data, batch_start: read_passing_events(tree, cut_data, batch_start,
+                                                                           bytes_read, other_branches)
+            for data, batch_start in iterate_batches(tree, cut_branches, task['entry_start'], task['entry_stop'],
+                                                     load=read_other, # this task's entry range
+                                                     read_branches=cut_branches + other_branches):
+                if data is None: # no events passed the cuts
+                    continue
+
+                if 'data' not in sample: # only do this for Monte Carlo simulation files
+                    # multiply all Monte Carlo weights and scale factors together to give total weight
+                    data['totalWeight'] = calc_weight_engine(xsec_weight, data)
+
+                # calculation of 4-lepton invariant mass using the function calc_mllll defined above
+                data['mllll'] = calc_mllll_engine(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
+
+                # array contents can be printed at any stage like this
+                #print(data)
+
+                # array column can be printed at any stage like this
+                #print(data['lep_pt'])
+
+                # multiple array columns can be printed at any stage like this
+                #print(data[['lep_pt','lep_eta']])
+
+                # later runs with the same selection read these events instead of the file
+                skim.write(data)
         
-            data_all.append(data) # append array from this batch
-            total_time = time.time() - start # calculate total time taken
+                if consumer_mode == 'histogram':
+                    fill_mllll(hist, data) # keep only the binned sums of weights
+                elif stream_batches: # send this batch straight away
+                    yield wire.encode(dict(header, seq=seq), data)
+                    seq += 1
+                else:
+                    data_all.append(data) # append array from this batch
+        # every read happens in turn in the reader, so the rest of the bytes are the cut branches
+        bytes_read['cuts'] = source.num_requested_bytes - before - bytes_read['other']
+        total_time = time.time() - start # calculate total time taken
     
-    data = ak.concatenate(data_all) # concatenate all of the arrays
-    ser_data = ak.to_list(data) # serialize the awkward array
-    data_and_sample = { 'sample': sample, 'data': ser_data } # create dictionary with sample name and data
-    pre_zipped_data = json.dumps(data_and_sample) # convert dictionary to JSON
-    zipped_data = zlib.compress(pre_zipped_data.encode('utf-8')) # compress serialised data
+    if consumer_mode == 'histogram': # only send the binned sums of weights
+        message = wire.encode(dict(header, seq=seq, end_of_task=True, histogram=True), payload=hist.to_bytes())
+    elif stream_batches or not data_all: # all batches have been sent or no events passed the cuts
+        message = wire.encode(dict(header, seq=seq, end_of_task=True))
+    else:
+        data = ak.concatenate(data_all) # concatenate all of the arrays
+        message = wire.encode(dict(header, seq=seq, end_of_task=True), data) # serialise the columns into one compressed message
     print(total_time) # print total time taken for comparison
-    return zipped_data
-
-def callback(ch, method, properties, body):
+    print(f"Bytes read for the cuts: {bytes_read['cuts']}, for the other branches: {bytes_read['other']}")
+    print(f"Byte-range cache: {httpcache.stats}")
+    yield message
+
+### Put a failed message back in its queue with its retry count, or drop it after max_retries
+# the original message is acknowledged either way
+def retry_or_drop(channel, delivery_tag, properties, body, queue):
+    retries = (properties.headers or {}).get('x-retries', 0) if properties else 0
+    if retries < max_retries:
+        channel.basic_publish(exchange='', routing_key=queue, body=body,
+                              properties=pika.BasicProperties(headers={'x-retries': retries + 1},
+                                                         delivery_mode=2)) # persistent, like the producer's tasks
+        print(f"Requeued message, retry {retries + 1} of {max_retries}")
+    else:
+        print(f"Dropping message after {max_retries} retries")
+    channel.basic_ack(delivery_tag=delivery_tag)
+
+### Publish one message to the outputter, runs on the connection's thread
+def publish(channel, data):
+    channel.basic_publish(exchange='', routing_key='processed_data', body=data)
+
+### Process a task on the processing thread, the connection's thread keeps servicing heartbeats
+# publishing and acknowledging are handed back to the connection's thread, in order
+def process_in_thread(connection, ch, delivery_tag, properties, body):
     try:
-        # process data
-        data = process_segment(body, tuple_path)
-
-        #send to output processor
-        ch.basic_publish(exchange='', routing_key='processed_data', body=data)
-        print(f"Processed data sent to outputter")
+        # process data and send each message to output processor
+        for data in process_segment(body, tuple_path):
+            connection.add_callback_threadsafe(functools.partial(publish, ch, data))
+        # acknowledge the task only once all of its results have been published
+        connection.add_callback_threadsafe(functools.partial(publish_and_ack, ch, delivery_tag, []))
     except Exception as e:
-        print(f"Failed to process data: {e}")
+        connection.add_callback_threadsafe(functools.partial(reject, ch, delivery_tag, properties, body, e))
+
+def callback(ch, method, properties, body, executor, connection):
+    executor.submit(process_in_thread, connection, ch, method.delivery_tag, properties, body)
 #    segment = json.loads(body)
 
  #   if isinstance(segment, list):
@@ -181,16 +490,136 @@ def callback(ch, method, properties, body):
        #     processed_data = process_segment(data)
         #    return processed_data   
 
-# connect to rabbitMQ
-connection = rabbitmq_connect('rabbitmq')
-channel = connection.channel()  
-# declare queue to receive messages from producer
-channel.queue_declare(queue='segmented_data')   
-# declare queue to send messages to outputter
-channel.queue_declare(queue='processed_data')
-
-# enbale consumer to receive messages from segmented_data queue
-channel.basic_consume(queue='segmented_data', on_message_callback=callback, auto_ack=True)
-
-print('Waiting for messages. To exit press CTRL+C')
-channel.start_consuming()
+### Run a task in a worker process, the messages are sent back to the main process through the pool's pipes
+def run_task(body):
+    return list(process_segment(body, tuple_path))
+
+### Publish the messages of a finished task and acknowledge it, runs on the connection's thread
+def publish_and_ack(channel, delivery_tag, messages):
+    for data in messages:
+        channel.basic_publish(exchange='', routing_key='processed_data', body=data)
+    channel.basic_ack(delivery_tag=delivery_tag)
+    print(f"Processed data sent to outputter")
+
+### Retry or drop a task that failed in a worker, runs on the connection's thread
+def reject(channel, delivery_tag, properties, body, error):
+    print(f"Failed to process data: {error}")
+    retry_or_drop(channel, delivery_tag, properties, body, 'segmented_data')
+
+### Start the worker processes, spawned rather than forked so they never share the connection's socket
+def start_workers(num_workers):
+    return concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+
+### Publish and acknowledge a task finished by a worker, or retry or drop it if it failed, runs on the
+# connection's thread
+# when a worker dies (e.g. killed for running out of memory) every task still in the pool fails with
+# BrokenProcessPool, and the worker processes are started again
+def pool_done(channel, delivery_tag, properties, body, future, workers, executor):
+    try:
+        messages = future.result()
+    except BrokenProcessPool as e:
+        if workers['executor'] is executor: # the first of its tasks to fail replaces the pool
+            print("A worker process died, starting the workers again")
+            executor.shutdown(wait=False)
+            workers['executor'] = start_workers(worker_processes)
+        reject(channel, delivery_tag, properties, body, e)
+    except Exception as e:
+        reject(channel, delivery_tag, properties, body, e)
+    else:
+        publish_and_ack(channel, delivery_tag, messages)
+
+### Callback for the worker pool mode: hand the task to a worker, and publish and acknowledge
+# it from the connection's thread once the worker has finished
+def pool_callback(ch, method, properties, body, workers, connection):
+    executor = workers['executor']
+    future = executor.submit(run_task, body)
+    future.add_done_callback(lambda future: connection.add_callback_threadsafe(
+        functools.partial(pool_done, ch, method.delivery_tag, properties, body, future, workers, executor)))
+
+### Compare the throughput of the awkward and numba engines on one file, in histogram mode
+# run with: python consumer.py benchmark <sample> [tuple_path]
+def benchmark_engines(sample, tuple_path, repeats=3):
+    global consumer_mode, event_engine
+    prefix = "Data/" if 'data' in sample else "MC/mc_"+str(infostore.infos[sample]["DSID"])+"."
+    with uproot.open(tuple_path+prefix+sample+".4lep.root:mini") as tree:
+        num_entries = tree.num_entries
+    task = json.dumps({'task_id': 'benchmark', 'prefix': prefix, 'sample': sample,
+                       'entry_start': 0, 'entry_stop': num_entries}).encode('utf-8')
+    consumer_mode = 'histogram'
+    engines = ['awkward'] + (['numba'] if fastloop.available else [])
+    hists = {}
+    for engine in engines:
+        event_engine = engine
+        list(process_segment(task, tuple_path)) # first run compiles and fills the caches
+        start = time.perf_counter()
+        for _ in range(repeats):
+            message, = process_segment(task, tuple_path)
+        elapsed = (time.perf_counter() - start) / repeats
+        # each task runs on a single core
+        print(f'{engine:>8}: {num_entries/elapsed:12.0f} events/s per core ({num_entries} events in {elapsed:.3f} s)')
+        hists[engine] = Histogram.from_bytes(wire.decode(message)[0]['payload'])
+    if 'numba' in hists: # the engines must fill the same histogram
+        if not np.allclose(hists['numba'].sumw, hists['awkward'].sumw, rtol=1e-5):
+            raise AssertionError(f'The numba engine filled {hists["numba"].sumw}, the awkward engine {hists["awkward"].sumw}')
+        print('The numba and awkward engines filled the same histogram')
+
+### Compare time and peak temporary memory of the two weight engines on the events of one Monte Carlo file
+def benchmark_weights(sample, tuple_path, repeats=3):
+    global weight_engine
+    import tracemalloc
+    prefix = "MC/mc_"+str(infostore.infos[sample]["DSID"])+"."
+    with uproot.open(tuple_path+prefix+sample+".4lep.root:mini") as tree:
+        events = tree.arrays(weight_branches, library="ak")
+    xsec_weight = get_xsec_weight(sample)
+    results = {}
+    for engine in ['awkward', 'numpy']:
+        weight_engine = engine
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            calc_weight_engine(xsec_weight, events)
+        elapsed = (time.perf_counter() - start) / repeats
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[engine] = ak.to_numpy(calc_weight_engine(xsec_weight, events))
+        # anything above the size of the result is temporary arrays
+        temporary = peak - results[engine].nbytes
+        print(f'{engine:>8}: {elapsed*1e3:8.2f} ms, {results[engine].dtype} result, '
+              f'temporary memory {temporary/1e6:7.3f} MB ({temporary/results[engine].nbytes:.1f}x the result)')
+    # the awkward engine multiplies in float32, the numpy engine in float64
+    print(f'largest relative difference: {np.max(np.abs(results["numpy"]/results["awkward"] - 1)):.2e}')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'benchmark':
+        benchmark_engines(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else tuple_path)
+        if 'data' not in sys.argv[2]:
+            benchmark_weights(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else tuple_path)
+        sys.exit()
+
+    if worker_processes > 1:
+        # the workers are started before connecting, this process holds the connection and the workers run the tasks
+        workers = {'executor': start_workers(worker_processes)}
+
+    # connect to rabbitMQ
+    connection = rabbitmq_connect(settings['broker']['host'])
+    channel = connection.channel()  
+    # declare queue to receive messages from producer
+    channel.queue_declare(queue='segmented_data', durable=True) # tasks survive a broker restart
+    # declare queue to send messages to outputter
+    channel.queue_declare(queue='processed_data')
+
+    # only take prefetch_count tasks per worker at a time, so the rest stay in the queue for the other consumers
+    channel.basic_qos(prefetch_count=prefetch_count*max(worker_processes, 1))
+    if worker_processes > 1:
+        channel.basic_consume(queue='segmented_data', auto_ack=False,
+                              on_message_callback=functools.partial(pool_callback, workers=workers, connection=connection))
+        print(f'Running tasks in {worker_processes} worker processes')
+    else:
+        # tasks run one at a time on a processing thread
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # enbale consumer to receive messages from segmented_data queue, tasks are acknowledged once processed
+        channel.basic_consume(queue='segmented_data', auto_ack=False,
+                              on_message_callback=functools.partial(callback, executor=executor, connection=connection))
+
+    print('Waiting for messages. To exit press CTRL+C')
+    channel.start_consuming()
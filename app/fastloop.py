@@ -0,0 +1,90 @@
+"""Numba-compiled event loop: lepton cuts, Monte Carlo weight and 4-lepton invariant mass in one pass, filling a histogram"""
+
+import math
+
+import awkward as ak
+import numpy as np
+
+try:
+    import numba
+except ImportError: # the consumer falls back to the awkward path
+    numba = None
+
+available = numba is not None
+
+MeV = 0.001
+
+
+### Compile with numba when it is installed, otherwise leave as plain python
+def jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+### Loop over the events once, walking the jagged lepton arrays through their offsets
+# weights holds one row per Monte Carlo weight branch, and no rows for data
+@jit
+def event_loop(offsets, lep_charge, lep_type, lep_pt, lep_eta, lep_phi, lep_E,
+               weights, xsec_weight, xmin, xmax, sumw, sumw2):
+    nbins = len(sumw)
+    width = (xmax - xmin) / nbins
+    num_passed = 0
+    for i in range(len(offsets) - 1):
+        first = offsets[i]
+        if offsets[i+1] - first < 4:
+            continue
+        # cut on lepton charge: sum of the first 4 charges must be 0
+        if lep_charge[first] + lep_charge[first+1] + lep_charge[first+2] + lep_charge[first+3] != 0:
+            continue
+        # cut on lepton type: eeee (44), mumumumu (52) or eemumu (48)
+        sum_lep_type = lep_type[first] + lep_type[first+1] + lep_type[first+2] + lep_type[first+3]
+        if sum_lep_type != 44 and sum_lep_type != 48 and sum_lep_type != 52:
+            continue
+        num_passed += 1
+
+        # invariant mass of the first 4 leptons
+        px = 0.0
+        py = 0.0
+        pz = 0.0
+        E = 0.0
+        for j in range(first, first + 4):
+            pt = float(lep_pt[j])
+            px += pt * math.cos(lep_phi[j])
+            py += pt * math.sin(lep_phi[j])
+            pz += pt * math.sinh(lep_eta[j])
+            E += lep_E[j]
+        squared = E*E - px*px - py*py - pz*pz
+        mass = math.copysign(math.sqrt(abs(squared)), squared) * MeV
+
+        # Monte Carlo weight
+        w = 1.0
+        if weights.shape[0] > 0:
+            w = xsec_weight
+            for k in range(weights.shape[0]):
+                w *= weights[k, i]
+
+        # fill the histogram, the last bin includes its upper edge like np.histogram
+        if mass < xmin or mass > xmax:
+            continue
+        b = min(int((mass - xmin) / width), nbins - 1)
+        sumw[b] += w
+        sumw2[b] += w * w
+    return num_passed
+
+
+### Run the event loop on a batch of events and add them to a histogram with equal width bins
+# returns the number of events passing the cuts
+def fill(hist, data, weight_branches, xsec_weight=None):
+    counts = ak.to_numpy(ak.num(data['lep_pt']))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    flat = {name: ak.to_numpy(ak.flatten(data[name])) for name in
+            ['lep_charge', 'lep_type', 'lep_pt', 'lep_eta', 'lep_phi', 'lep_E']}
+    if xsec_weight is None: # data events are not weighted
+        weights = np.empty((0, len(counts)))
+    else:
+        weights = np.stack([ak.to_numpy(data[name]).astype(np.float64) for name in weight_branches])
+    return event_loop(offsets, flat['lep_charge'], flat['lep_type'].astype(np.int64), flat['lep_pt'],
+                      flat['lep_eta'], flat['lep_phi'], flat['lep_E'], weights,
+                      float(xsec_weight or 1.0), hist.edges[0], hist.edges[-1], hist.sumw, hist.sumw2)
@@ -0,0 +1,181 @@
+"""Local on-disk cache of remote ROOT files, shared by the consumers through a volume
+
+Each copy is kept with the size, ETag and Last-Modified time of the remote file, and is downloaded
+again when the server reports a different version. When the server does not answer, a copy is only
+used if its sha256 checksum matches the one recorded at download.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import urllib.request
+
+from config import settings
+
+# Directory holding the cached files, caching is turned off when this is empty
+cache_dir = settings['cache']['file_cache_dir'] or None
+# Maximum size of the cache in bytes, the least recently used files are removed above this
+max_bytes = int(float(settings['cache']['file_cache_max_gb']) * 1e9)
+# A download lock older than this (in seconds) is from a worker that died and is ignored
+lock_timeout = 3600
+
+
+### Name of the cached copy of a url
+def cache_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+### Read the metadata stored next to a cached file
+def read_meta(path):
+    try:
+        with open(path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+### Version of a remote file from the headers of a response: size, ETag and Last-Modified
+# the same as fileindex.file_version gives the producer
+def version_of(headers):
+    size = headers.get('Content-Length')
+    return {'size': int(size) if size is not None else None,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified')}
+
+
+### Version of a remote file, asking the server for the headers only
+def remote_version(url):
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return version_of(response.headers)
+
+
+### Check a cached file against the size and checksum recorded when it was downloaded, and against
+# the current version of the remote file when it is known
+# check_sha256 reads the whole file, fetch only asks for it when the remote version is unknown
+def is_valid(path, meta, version=None, check_sha256=False):
+    if meta is None or not os.path.exists(path):
+        return False
+    if os.path.getsize(path) != meta['size']:
+        return False
+    if version is not None and meta.get('version') != version: # the remote file has changed
+        return False
+    if check_sha256:
+        return file_sha256(path) == meta['sha256']
+    return True
+
+
+### Checksum of a file on disk
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+### Download a url into the cache, writing to a temporary file and renaming it when complete
+def download(url, path):
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as tmp, urllib.request.urlopen(url, timeout=60) as response:
+            expected = response.headers.get('Content-Length')
+            for block in iter(lambda: response.read(1 << 20), b''):
+                tmp.write(block)
+                digest.update(block)
+                size += len(block)
+        if expected is not None and int(expected) != size: # incomplete download
+            raise IOError(f'Downloaded {size} bytes of {url}, expected {expected}')
+        meta = {'url': url, 'size': size, 'sha256': digest.hexdigest(),
+                'version': version_of(response.headers)} # compared with the remote file on every fetch
+        with open(tmp_path + '.json', 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path + '.json', path + '.json')
+        os.replace(tmp_path, path) # atomic, other workers never see a partial file
+    except BaseException:
+        for p in (tmp_path, tmp_path + '.json'):
+            if os.path.exists(p):
+                os.remove(p)
+        raise
+    return meta
+
+
+### Remove the least recently used files ending in suffix until the cache fits in max_bytes
+def evict(directory, max_bytes, keep=None, suffix='.root'):
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(suffix):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError: # removed by another worker
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries): # oldest access first
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        for p in (path, path + '.json'):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+        total -= size
+
+
+### Remove a download lock, another worker may already have removed it as stale
+def remove_lock(lock_path):
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+
+
+### Get a local copy of a url, downloading it into the cache if it is not cached or has changed
+# returns the url itself when caching is off or another worker is already downloading it
+def fetch(url, directory=None):
+    directory = directory or cache_dir
+    if not directory or not url.startswith('http'):
+        return url
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, cache_key(url) + '.root')
+
+    try:
+        version = remote_version(url)
+    except Exception as e: # the server did not answer, use the cached copy if its checksum is right
+        print(f'Failed to get version of {url}, using the cached copy if there is one: {e}')
+        version = None
+    if is_valid(path, read_meta(path), version, check_sha256=version is None):
+        os.utime(path) # mark as recently used
+        return path
+
+    lock_path = path + '.lock'
+    try:
+        lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            age = time.time() - os.path.getmtime(lock_path)
+        except OSError: # the other download has just finished
+            return fetch(url, directory)
+        if age < lock_timeout:
+            return url # read remotely rather than wait for the other download
+        remove_lock(lock_path) # stale lock
+        return fetch(url, directory)
+    try:
+        os.close(lock)
+        print(f'Downloading {url} into file cache')
+        download(url, path)
+        evict(directory, max_bytes, keep=path)
+    except Exception as e:
+        print(f'Failed to cache {url}, reading it remotely: {e}')
+        return url
+    finally:
+        remove_lock(lock_path)
+    return path
@@ -0,0 +1,113 @@
+"""Index of the input files built by the producer before it publishes the tasks
+
+For each file the index holds its size, number of entries, the compressed and uncompressed size of
+every branch, and the basket boundaries and basket sizes of the branches the consumers read. All of
+it comes from the file headers and branch metadata, no baskets are read. The index is cached on
+disk and a file is only probed again when its ETag, Last-Modified time (remote files) or
+modification time (local files) changes.
+"""
+
+import json
+import os
+import urllib.request
+
+import uproot
+
+
+### Load the cached index, keyed by file url
+def load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError): # no index yet or unreadable index
+        return {}
+
+
+### Save the index, writing to a temporary file so a crash never leaves half an index
+def save(path, index):
+    tmp_path = path + '.part'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+### Version of a file: size with ETag and Last-Modified of a remote file, or mtime of a local one
+def file_version(url):
+    if not url.startswith('http'): # local file
+        stat = os.stat(url)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+    request = urllib.request.Request(url, method='HEAD') # only ask for the headers
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return {'size': int(response.headers['Content-Length']),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+
+
+### Read the metadata of one tree, basket details are only kept for the branches in read_branches
+def probe(url, read_branches, tree_name='mini'):
+    with uproot.open(url + ':' + tree_name) as tree:
+        entry = {'num_entries': tree.num_entries, 'branches': {}}
+        for name, branch in tree.items():
+            info = {'compressed_bytes': int(branch.compressed_bytes),
+                    'uncompressed_bytes': int(branch.uncompressed_bytes)}
+            if name in read_branches:
+                info['basket_offsets'] = [int(x) for x in branch.entry_offsets]
+                info['basket_bytes'] = [branch.basket_compressed_bytes(i) for i in range(branch.num_baskets)]
+            entry['branches'][name] = info
+        # entries at which every branch read by the consumers starts a new basket
+        present = [name for name in read_branches if name in entry['branches']]
+        entry['common_offsets'] = [int(x) for x in tree.common_entry_offsets(filter_name=present)]
+    return entry
+
+
+### Get the index entry of a file, probing it when it is not indexed or has changed
+# returns None if the file cannot be read and has never been indexed
+def lookup(index, url, read_branches):
+    try:
+        version = file_version(url)
+    except Exception as e:
+        if url in index: # the server did not answer, trust the cached entry
+            print(f"Failed to get version of {url}, using the cached index: {e}")
+            return index[url]
+        version = None
+    if url in index and version is not None and index[url].get('version') == version:
+        return index[url]
+    try:
+        entry = probe(url, read_branches)
+    except Exception as e:
+        print(f"Failed to index {url}: {e}")
+        return None
+    entry['version'] = version
+    index[url] = entry
+    print(f"Indexed {url}: {entry['num_entries']} entries")
+    return entry
+
+
+### Bytes of the read branches in the baskets overlapping an entry range
+def range_bytes(entry, read_branches, entry_start, entry_stop):
+    total = 0
+    for name in read_branches:
+        info = entry['branches'].get(name)
+        if info is None or 'basket_offsets' not in info:
+            continue
+        offsets = info['basket_offsets']
+        for i, size in enumerate(info['basket_bytes']):
+            if offsets[i] < entry_stop and offsets[i + 1] > entry_start:
+                total += size
+    return total
+
+
+### Split a file into entry ranges of about entries_per_task entries that start and stop on basket
+# boundaries shared by every branch read, so no basket is read by two tasks
+# a boundary is only moved when a shared one is at most entries_per_task entries further on
+def split_aligned(num_entries, entries_per_task, common_offsets):
+    boundaries = sorted(set(common_offsets) | {num_entries})
+    ranges = [] # list of (entry_start, entry_stop) pairs
+    entry_start = 0
+    while entry_start < num_entries:
+        target = min(entry_start + entries_per_task, num_entries)
+        aligned = next((b for b in boundaries if b >= target), num_entries)
+        entry_stop = aligned if aligned - target <= entries_per_task else target
+        ranges.append((entry_start, min(entry_stop, num_entries)))
+        entry_start = entry_stop
+    return ranges
@@ -0,0 +1,84 @@
+"""Histogram with fixed bin edges that can be filled batch by batch and merged with +"""
+
+import struct
+
+import numpy as np
+
+
+class Histogram:
+
+    def __init__(self, edges, sumw=None, sumw2=None):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        nbins = len(self.edges) - 1
+        self.sumw = np.zeros(nbins) if sumw is None else np.array(sumw, dtype=np.float64) # sum of weights
+        self.sumw2 = np.zeros(nbins) if sumw2 is None else np.array(sumw2, dtype=np.float64) # sum of weights squared
+        # equal width bins can use numpy's faster histogramming
+        widths = np.diff(self.edges)
+        self.uniform = np.allclose(widths, widths[0])
+
+    @property
+    def centres(self):
+        return (self.edges[:-1] + self.edges[1:]) / 2
+
+    @property
+    def errors(self):
+        return np.sqrt(self.sumw2) # statistical error in each bin
+
+    ### Add a batch of values, unweighted values count as weight 1
+    def fill(self, values, weights=None):
+        values = np.asarray(values)
+        bins = (len(self.sumw), (self.edges[0], self.edges[-1])) if self.uniform else (self.edges, None)
+        if weights is None:
+            counts,_ = np.histogram(values, bins=bins[0], range=bins[1])
+            self.sumw += counts
+            self.sumw2 += counts
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            sumw,_ = np.histogram(values, bins=bins[0], range=bins[1], weights=weights)
+            sumw2,_ = np.histogram(values, bins=bins[0], range=bins[1], weights=weights*weights)
+            self.sumw += sumw
+            self.sumw2 += sumw2
+        return self
+
+    def copy(self):
+        return Histogram(self.edges, self.sumw, self.sumw2)
+
+    ### Add another histogram with the same binning to this one
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Cannot merge histograms with different bin edges')
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __add__(self, other):
+        return self.copy().merge(other)
+
+    def __radd__(self, other):
+        if other == 0: # so that sum() works on a list of histograms
+            return self.copy()
+        return other + self
+
+    ### Merge each group of `factor` adjacent bins into one bin
+    def rebin(self, factor):
+        if len(self.sumw) % factor != 0:
+            raise ValueError(f'Cannot merge {len(self.sumw)} bins in groups of {factor}')
+        return Histogram(self.edges[::factor],
+                         self.sumw.reshape(-1, factor).sum(axis=1),
+                         self.sumw2.reshape(-1, factor).sum(axis=1))
+
+    ### Number of bins followed by the edges, sums of weights and sums of weights squared as float64
+    def to_bytes(self):
+        return struct.pack('<I', len(self.sumw)) + np.concatenate([self.edges, self.sumw, self.sumw2]).astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, body):
+        (nbins,) = struct.unpack_from('<I', body)
+        values = np.frombuffer(body, dtype='<f8', offset=4, count=3*nbins + 1)
+        return cls(values[:nbins+1], values[nbins+1:2*nbins+1], values[2*nbins+1:])
+
+    def __repr__(self):
+        return f'Histogram({len(self.sumw)} bins from {self.edges[0]} to {self.edges[-1]}, total {self.sumw.sum():g})'
@@ -0,0 +1,187 @@
+"""Byte-range read cache for uproot's HTTP source, keyed by (url, file version, byte offset, length)
+
+The version is the size, ETag and Last-Modified time of the remote file, so byte ranges of a file
+that has been replaced on the server are never mixed with the new ones.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import queue
+import tempfile
+import threading
+
+import uproot
+
+import filecache
+from config import settings
+
+# Size of the in-memory tier in bytes
+memory_bytes = int(float(settings['cache']['basket_cache_mb']) * 1e6)
+# Directory of the on-disk tier, shared between consumers through a volume (off when empty)
+disk_dir = settings['cache']['basket_cache_dir'] or None
+# Maximum size of the on-disk tier in bytes, the least recently used ranges are removed above this
+disk_max_bytes = int(float(settings['cache']['basket_cache_max_gb']) * 1e9)
+
+# Hit and miss counters for the consumers to report
+stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'bytes_fetched': 0, 'bytes_cached': 0}
+
+
+### Least recently used store of byte ranges held in memory
+class MemoryTier:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock() # uproot reads from several threads
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                return None
+            self.data.move_to_end(key) # mark as recently used
+            return self.data[key]
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.data:
+                return
+            self.data[key] = value
+            self.nbytes += len(value)
+            while self.nbytes > self.max_bytes: # drop least recently used ranges
+                _, old = self.data.popitem(last=False)
+                self.nbytes -= len(old)
+
+
+### Store of byte ranges as files in a directory, the least recently used are removed above max_bytes
+class DiskTier:
+    def __init__(self, directory, max_bytes=disk_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.written = 0 # bytes written since the last eviction
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        url, version, start, length = key
+        name = hashlib.sha256(f'{url}\n{version}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{name}_{start}_{length}.range')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path) # mark as recently used
+        except OSError:
+            return None
+        return value if len(value) == key[-1] else None # ignore truncated files
+
+    def put(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_path, self.path(key)) # atomic, readers never see a partial range
+        self.written += len(value)
+        if self.written > self.max_bytes / 10: # listing the directory on every write would be slow
+            filecache.evict(self.directory, self.max_bytes, suffix='.range')
+            self.written = 0
+
+
+memory_tier = MemoryTier(memory_bytes)
+disk_tier = DiskTier(disk_dir) if disk_dir else None
+
+
+### Look a byte range up in the memory tier then the disk tier
+def lookup(key):
+    value = memory_tier.get(key)
+    if value is not None:
+        stats['memory_hits'] += 1
+        return value
+    if disk_tier is not None:
+        value = disk_tier.get(key)
+        if value is not None:
+            stats['disk_hits'] += 1
+            memory_tier.put(key, value)
+            return value
+    stats['misses'] += 1
+    return None
+
+
+### Add a byte range fetched from the server to both tiers
+def store(key, value):
+    stats['bytes_fetched'] += len(value)
+    memory_tier.put(key, value)
+    if disk_tier is not None:
+        try:
+            disk_tier.put(key, value)
+            stats['bytes_cached'] += len(value)
+        except OSError as e: # a full disk should not stop the analysis
+            print(f'Failed to write byte range to disk cache: {e}')
+
+
+### Reset the counters, e.g. at the start of each task
+def reset_stats():
+    for k in stats:
+        stats[k] = 0
+
+
+### Version of a remote file as a string for the cache keys, None when the server does not answer
+def file_version(url):
+    try:
+        return json.dumps(filecache.remote_version(url), sort_keys=True)
+    except Exception as e:
+        print(f'Failed to get version of {url}, not caching its byte ranges: {e}')
+        return None
+
+
+### uproot HTTP source that serves byte ranges from the cache and only fetches the missing ones
+# use with uproot.open(url, handler=CachingHTTPSource)
+# the file version is asked for once when the file is opened, ranges of an unknown version are not cached
+class CachingHTTPSource(uproot.source.http.HTTPSource):
+
+    def __init__(self, file_path, **options):
+        super().__init__(file_path, **options)
+        self.version = file_version(file_path)
+
+    def key(self, start, stop):
+        return (self.file_path, self.version, start, stop - start)
+
+    def cached_chunk(self, start, stop, value):
+        future = uproot.source.futures.TrivialFuture(value)
+        return uproot.source.chunk.Chunk(self, start, stop, future)
+
+    def chunk(self, start, stop):
+        if self.version is None:
+            return super().chunk(start, stop)
+        key = self.key(start, stop)
+        value = lookup(key)
+        if value is not None:
+            return self.cached_chunk(start, stop, value)
+        chunk = super().chunk(start, stop)
+        chunk.wait()
+        store(key, bytes(chunk.raw_data))
+        return chunk
+
+    def chunks(self, ranges, notifications):
+        if self.version is None:
+            return super().chunks(ranges, notifications)
+        chunks = {}
+        missing = []
+        for start, stop in ranges:
+            value = lookup(self.key(start, stop))
+            if value is None:
+                missing.append((start, stop))
+            else:
+                chunks[start, stop] = self.cached_chunk(start, stop, value)
+                notifications.put(chunks[start, stop])
+        if missing: # fetch all missing ranges in one request as uproot would
+            fetched = super().chunks(missing, queue.Queue())
+            for chunk in fetched:
+                chunk.wait()
+                store(self.key(chunk.start, chunk.stop), bytes(chunk.raw_data))
+                chunks[chunk.start, chunk.stop] = chunk
+                notifications.put(chunk)
+        return [chunks[start, stop] for start, stop in ranges]
@@ -0,0 +1,87 @@
+"""Compact table of the dataset metadata in infofile.py, read on the first lookup
+
+infostore.csv has one row per dataset (name, DSID, events, red_eff, sumw, xsec). It is generated
+from infofile.infos with "python infostore.py" and must be regenerated when infofile.py changes.
+infos can be used like the infofile dict, and dsid_names finds the datasets with a DSID.
+"""
+
+import collections.abc
+import os
+
+# Table generated from infofile.py, next to this module
+table_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'infostore.csv')
+# Columns after the dataset name, 'events' is empty for the datasets that do not have it
+fields = ['DSID', 'events', 'red_eff', 'sumw', 'xsec']
+
+
+### Numbers are written with repr, so ints stay ints and floats read back exactly
+def parse(value):
+    if value.lstrip('-').isdigit():
+        return int(value)
+    return float(value)
+
+
+### Read-only dict of dataset name to metadata, indexed by name and by DSID once loaded
+class InfoStore(collections.abc.Mapping):
+
+    def __init__(self, path):
+        self.path = path
+        self.by_name = None
+        self.by_dsid = None
+
+    def load(self):
+        if self.by_name is not None:
+            return
+        by_name = {}
+        by_dsid = {}
+        with open(self.path) as f:
+            columns = f.readline().rstrip('\n').split(',')[1:]
+            for line in f: # plain comma separated values, no quoting
+                name, *values = line.rstrip('\n').split(',')
+                by_name[name] = {k: parse(v) for k, v in zip(columns, values) if v != ''}
+                by_dsid.setdefault(by_name[name]['DSID'], []).append(name) # some DSIDs have several names
+        self.by_name, self.by_dsid = by_name, by_dsid
+
+    def __getitem__(self, name):
+        self.load()
+        return self.by_name[name]
+
+    def __contains__(self, name):
+        self.load()
+        return name in self.by_name
+
+    def __iter__(self):
+        self.load()
+        return iter(self.by_name)
+
+    def __len__(self):
+        self.load()
+        return len(self.by_name)
+
+    ### Names of the datasets with a DSID, empty if there are none
+    def dsid_names(self, dsid):
+        self.load()
+        return list(self.by_dsid.get(int(dsid), []))
+
+
+infos = InfoStore(table_path)
+
+
+def dsid_names(dsid):
+    return infos.dsid_names(dsid)
+
+
+### Write the table from infofile.infos
+def build(path=table_path):
+    import infofile
+    with open(path, 'w') as f:
+        f.write(','.join(['name'] + fields) + '\n')
+        for name, info in infofile.infos.items():
+            if ',' in name:
+                raise ValueError(f'Dataset name {name!r} cannot be written to the table')
+            f.write(','.join([name] + [repr(info[k]) if k in info else '' for k in fields]) + '\n')
+    print(f'Wrote {len(infofile.infos)} datasets to {path}')
+
+
+if __name__ == '__main__':
+    build()
@@ -0,0 +1,88 @@
+"""Ledger of the tasks of earlier runs, so that a re-run only processes the tasks that are new or changed
+
+Each task has a fingerprint of its input (file url, ETag or size and modification time, entry range),
+a hash of the consumer code (selection.result_code) and the configuration. The outputter records the fingerprint of
+every completed task and keeps the messages its consumer sent. The producer only publishes tasks
+whose fingerprint differs from the ledger, and the outputter merges the kept messages for the others.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+
+from config import settings
+
+# Directory holding the ledger and the kept messages, the ledger is turned off when this is empty
+ledger_dir = settings['cache']['ledger_dir'] or None
+enabled = bool(ledger_dir)
+
+
+### Fingerprint of a task, None when the version of its file is not known
+def fingerprint(url, version, entry_start, entry_stop, code_version, config):
+    if version is None: # always processed again
+        return None
+    key = json.dumps([url, version, entry_start, entry_stop, code_version, config], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]
+
+
+def ledger_path():
+    return os.path.join(ledger_dir, 'ledger.json')
+
+
+def result_path(task_fingerprint):
+    return os.path.join(ledger_dir, 'results', task_fingerprint + '.bin')
+
+
+### Write a file through a temporary file, so a crash never leaves it half written
+def atomic_write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+### Load the ledger, task id to the fingerprint it was last completed with
+def load():
+    if not enabled:
+        return {}
+    try:
+        with open(ledger_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError): # no ledger yet or unreadable ledger
+        return {}
+
+
+def save(ledger):
+    atomic_write(ledger_path(), json.dumps(ledger).encode('utf-8'))
+
+
+### Check if a task was completed with the same fingerprint and its messages were kept
+def is_fresh(ledger, task_id, task_fingerprint):
+    record = ledger.get(task_id)
+    return (task_fingerprint is not None and record is not None and record['fingerprint'] == task_fingerprint
+            and os.path.exists(result_path(task_fingerprint)))
+
+
+### Keep the messages of a completed task and record its fingerprint
+def record(ledger, task_id, task_fingerprint, bodies):
+    atomic_write(result_path(task_fingerprint),
+                 b''.join(struct.pack('<Q', len(body)) + bytes(body) for body in bodies))
+    ledger[task_id] = {'fingerprint': task_fingerprint, 'time': time.time()}
+    save(ledger)
+
+
+### Messages kept for a fingerprint
+def read_result(task_fingerprint):
+    with open(result_path(task_fingerprint), 'rb') as f:
+        data = f.read()
+    bodies = []
+    position = 0
+    while position < len(data):
+        (length,) = struct.unpack_from('<Q', data, position)
+        bodies.append(data[position + 8:position + 8 + length])
+        position += 8 + length
+    return bodies
@@ -15,52 +15,12 @@
 #from matplotlib.ticker import AutoMinorLocator # for minor ticks
 #import pika
 
-import infofile # local file containing cross-sections, sums of weights, dataset IDs
-
-
-#lumi = 0.5 # fb-1 # data_A only
-#lumi = 1.9 # fb-1 # data_B only
-#lumi = 2.9 # fb-1 # data_C only
-#lumi = 4.7 # fb-1 # data_D only
-lumi = 10 # fb-1 # data_A,data_B,data_C,data_D
-
-fraction = 1.0 # reduce this is if you want the code to run quicker
-                                                                                                                                  
-#tuple_path = "Input/4lep/" # local 
-tuple_path = "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/" # web address
+import infostore # table of cross-sections, sums of weights, dataset IDs generated from infofile.py
+from config import lumi, fraction, tuple_path, samples, MeV, GeV # shared pipeline configuration
 
 # Define number of workers to be used
 number_workers = 4
 
-samples = {
-
-    'data': {
-        'list' : ['data_A','data_B','data_C','data_D'],
-    },
-
-    r'Background $Z,t\bar{t}$' : { # Z + ttbar
-        'list' : ['Zee','Zmumu','ttbar_lep'],
-        'color' : "#6b59d3" # purple
-    },
-
-    r'Background $ZZ^*$' : { # ZZ
-        'list' : ['llll'],
-        'color' : "#ff0000" # red
-    },
-
-    r'Signal ($m_H$ = 125 GeV)' : { # H -> ZZ -> llll
-        'list' : ['ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep'],
-        'color' : "#00cdff" # light blue
-    },
-
-}
-
-
-
-### Units ###
-MeV = 0.001
-GeV = 1.0
-
 ##Get data
 
 def get_data_from_files():
@@ -72,7 +32,7 @@ def get_data_from_files():
         for val in samples[s]['list']: # loop over each file
             if s == 'data': prefix = "Data/" # Data prefix
             else: # MC prefix
-                prefix = "MC/mc_"+str(infofile.infos[val]["DSID"])+"."
+                prefix = "MC/mc_"+str(infostore.infos[val]["DSID"])+"."
             fileString = tuple_path+prefix+val+".4lep.root" # file name to open
             temp = read_file(fileString,val) # call the function read_file defined below
             frames.append(temp) # append array returned from read_file to list of awkward arrays
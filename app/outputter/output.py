@@ -6,42 +6,55 @@ import awkward as ak
 import vector
 import time
 import json
-import infofile
+import os
 import numpy as np
 import matplotlib.pyplot as plt
-import zlib
+import wire # columnar message format
+from histogram import Histogram # mergeable histogram
+import skimstore # Parquet store of the events passing the selection
+import ledger # fingerprints and messages of the tasks completed in earlier runs
+from config import settings, config_id, lumi, fraction, MeV, GeV, samples # shared pipeline configuration
 from matplotlib.ticker import AutoMinorLocator  # for minor ticks
 
-# Define the merged data dictionary
+# Define the merged data dictionary, holding a list of the arrays received for each sample
 merged_data = {}
-lumi = 10
-fraction = 1.0
-### Units ###
-MeV = 0.001
-GeV = 1.0
-
-samples = {
-
-    'data': {
-        'list' : ['data_A','data_B','data_C','data_D'],
-    },
-
-    r'Background $Z,t\bar{t}$' : { # Z + ttbar
-        'list' : ['Zee','Zmumu','ttbar_lep'],
-        'color' : "#6b59d3" # purple
-    },
-
-    r'Background $ZZ^*$' : { # ZZ
-        'list' : ['llll'],
-        'color' : "#ff0000" # red
-    },
-
-    r'Signal ($m_H$ = 125 GeV)' : { # H -> ZZ -> llll
-        'list' : ['ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep'],
-        'color' : "#00cdff" # light blue
-    },
-
-}
+# Define the merged histograms dictionary, filled by consumers in histogram mode
+merged_hists = {}
+# Messages received for each task from its latest attempt, merged once they have all arrived,
+# and the tasks whose messages have all arrived
+task_messages = {}
+completed_tasks = set()
+# Run manifest sent by the producer, None until it arrives
+manifest = None
+# Runs whose manifest was replaced by the manifest of a later run, their messages are dropped
+superseded_runs = set()
+# Messages held unacknowledged until the manifest of their run arrives, as (delivery tag, properties, body)
+held_messages = []
+run_ledger = ledger.load()
+outputter_settings = settings['outputter']
+# Seconds to wait for all the tasks of the run before plotting whatever has arrived
+run_timeout = float(outputter_settings['run_timeout'])
+# Directory to save the plot and the run summary in
+output_dir = outputter_settings['output_dir']
+# number of unacknowledged messages the broker sends to the outputter at a time
+prefetch_count = outputter_settings['prefetch_count']
+# number of times a message that failed to merge is put back in the queue before it is dropped
+max_retries = outputter_settings['max_retries']
+
+# Map each file to the sample it belongs to
+sample_groups = {val: s for s in samples for val in samples[s]['list']}
+
+### Histogram binning, the consumers use the same binning in histogram mode
+xmin = settings['binning']['xmin'] * GeV
+xmax = settings['binning']['xmax'] * GeV
+step_size = settings['binning']['step_size'] * GeV
+
+bin_edges = np.arange(start=xmin, # The interval includes this value
+                                        stop=xmax+step_size, # The interval doesn't include this value
+                                        step=step_size ) # Spacing between values
+bin_centres = np.arange(start=xmin+step_size/2, # The interval includes this value
+                                        stop=xmax+step_size/2, # The interval doesn't include this value
+                                        step=step_size ) # Spacing between values
 
 
 
@@ -58,26 +71,245 @@ def rabbitmq_connect(host, retries=10, delay=5):
 
 
 
+### Add a histogram to the merged histograms
+def add_histogram(sample, hist):
+    if sample not in merged_hists:
+        merged_hists[sample] = Histogram(hist.edges)
+    merged_hists[sample] += hist
+
 # Function to process each segment of data
 def process_segment(segment):
-    sample = segment['sample']
+    sample = sample_groups.get(segment['sample'], segment['sample']) # merge files of the same sample
+    if 'hist' in segment: # histogram from a consumer in histogram mode
+        add_histogram(sample, segment['hist'])
+        return
     data = segment['data']
 
-    if sample not in merged_data:
-        merged_data[sample] = data
+    # keep the arrays in a list rather than concatenating on every message, which copies
+    # everything received so far each time
+    merged_data.setdefault(sample, []).append(data)
+
+### Concatenate the arrays received for each sample
+# the list is replaced by the result, so each array is only copied once
+def snapshot(merged_data):
+    for s in merged_data:
+        if len(merged_data[s]) > 1:
+            merged_data[s] = [ak.concatenate(merged_data[s])]
+    return {s: merged_data[s][0] for s in merged_data}
+
+### Check if a message has already been merged or received, e.g. when a consumer sends a failed task
+# again, or is from an earlier attempt at a task that has been started again
+def is_duplicate(header):
+    task_id = header.get('task_id')
+    if task_id in completed_tasks:
+        return True
+    received = task_messages.get(task_id)
+    if received is None:
+        return False
+    if header.get('attempt', 0) != received['attempt']:
+        return header.get('attempt', 0) < received['attempt']
+    return header['seq'] in received['seqs']
+
+### Record a message of a task, the task is complete once its end of task message and all the messages
+# before it from the same attempt have arrived (they can arrive out of order)
+# the messages are only merged then: a retried task can split its entries into different batches, so
+# the messages of an earlier attempt are dropped when a later attempt starts
+def track_message(header, data, body):
+    task_id = header.get('task_id')
+    if task_id is None: # not part of a task, merged straight away
+        merge_message(header, data)
+        return
+    attempt = header.get('attempt', 0)
+    received = task_messages.get(task_id)
+    if received is not None and attempt > received['attempt']:
+        print(f'Dropping {len(received["seqs"])} messages of an earlier attempt at task {task_id}')
+        received = None
+    if received is None:
+        received = task_messages[task_id] = {'attempt': attempt, 'seqs': set(), 'last': None,
+                                             'messages': [], 'bodies': []}
+    received['seqs'].add(header['seq'])
+    received['messages'].append((header, data))
+    if ledger.enabled and header.get('fingerprint'): # recorded in the ledger once the task completes
+        received['bodies'].append(body)
+    if header.get('end_of_task'):
+        received['last'] = header['seq']
+    if received['last'] is not None and len(received['seqs']) == received['last'] + 1:
+        for message in received['messages']:
+            merge_message(*message)
+        completed_tasks.add(task_id)
+        del task_messages[task_id]
+        record_task(header, received['bodies'])
+        print(f'completed task {task_id}')
+
+### Record a completed task and its messages in the ledger, so later runs do not process it again
+def record_task(header, bodies):
+    if not bodies:
+        return
+    try:
+        ledger.record(run_ledger, header['task_id'], header['fingerprint'], bodies)
+    except OSError as e: # the task is just processed again next time
+        print(f'Failed to record task {header["task_id"]} in the ledger: {e}')
+
+### Tasks of the run that have not completed yet
+def missing_tasks():
+    if manifest is None:
+        return []
+    return [task_id for task_id in manifest['task_ids'] if task_id not in completed_tasks]
+
+### Stop consuming once every task in the manifest has completed
+def check_run_complete(ch):
+    if manifest is not None and not missing_tasks():
+        print(f'All {manifest["num_tasks"]} tasks of run {manifest["run_id"]} completed')
+        ch.stop_consuming()
+
+### Stop waiting for the run and report the tasks that have not arrived
+def on_timeout():
+    if manifest is None:
+        print(f'Timed out after {run_timeout} s without receiving a run manifest')
     else:
-        merged_data[sample] = ak.concatenate([merged_data[sample], data])
+        missing = missing_tasks()
+        print(f'Timed out after {run_timeout} s, {len(missing)} of {manifest["num_tasks"]} tasks missing:')
+        for task_id in missing:
+            print(f'  {task_id}')
+    channel.stop_consuming()
+
+### Merge a decoded message into the merged histograms or events
+def merge_message(header, data):
+    if header.get('histogram'): # only the binned sums of weights were sent
+        process_segment({'sample': header['sample'], 'hist': Histogram.from_bytes(header['payload'])})
+    elif data is not None: # the end of task marker of a streamed task has no data
+        process_segment({'sample': header['sample'], 'data': data})
+
+### Merge the tasks whose messages an earlier run kept in the ledger, no consumer sends these
+def read_cached(manifest):
+    for task in manifest.get('cached', []):
+        if task['task_id'] in completed_tasks:
+            continue
+        try:
+            bodies = ledger.read_result(task['fingerprint'])
+        except Exception as e: # the task is reported as missing if the run times out
+            print(f'Failed to read task {task["task_id"]} from the ledger: {e}')
+            continue
+        for body in bodies:
+            merge_message(*wire.decode(body))
+        completed_tasks.add(task['task_id'])
+        print(f'read task {task["task_id"]} from the ledger')
+
+### Merge the tasks the producer found in the skim store, no consumer sends these
+def read_skims(manifest):
+    for task in manifest.get('skimmed', []):
+        if task['task_id'] in completed_tasks:
+            continue
+        try:
+            data = skimstore.read(manifest['selection'], task['sample'], task['entry_start'], task['entry_stop'],
+                                  task['source'])
+        except Exception as e: # the task is reported as missing if the run times out
+            print(f'Failed to read skim of task {task["task_id"]}: {e}')
+            continue
+        if len(data) > 0: # an empty skim means no events passed the cuts
+            process_segment({'sample': task['sample'], 'data': data})
+        completed_tasks.add(task['task_id'])
+        print(f'read skim of task {task["task_id"]}')
+
+### Forget everything merged for the current run, when the manifest of a later run replaces it
+def reset_run():
+    for state in (merged_data, merged_hists, task_messages, completed_tasks):
+        state.clear()
+
+### Check if a manifest is from a later run than the current one, by the time the runs started
+def is_later_run(new_manifest):
+    return new_manifest.get('created', 0) > manifest.get('created', 0)
+
+### What to do with a message: 'merge' it into the current run, 'hold' it until the manifest of its run
+# arrives, or 'drop' it when it is from an earlier run (e.g. one that timed out and left its results)
+def message_action(header):
+    if manifest is None:
+        return 'hold'
+    run_id = header.get('run_id')
+    if run_id is None or run_id == manifest['run_id']: # not sent for a run, e.g. by a benchmark
+        return 'merge'
+    if run_id in superseded_runs:
+        return 'drop'
+    run_created = header.get('run_created')
+    if run_created is not None and 'created' in manifest and run_created < manifest['created']:
+        return 'drop'
+    return 'hold' # a later run, whose manifest is on its way
+
+### Handle the held messages again, once a manifest has arrived
+def release_held(ch):
+    global held_messages
+    messages, held_messages = held_messages, []
+    for delivery_tag, properties, body in messages:
+        handle_message(ch, delivery_tag, properties, body)
+
+# Callback function for receiving the run manifest
+# a manifest of a later run replaces the current one, a manifest of an earlier run is ignored
+def manifest_callback(ch, method, properties, body):
+    global manifest
+    new_manifest = json.loads(body)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    if manifest is not None:
+        if new_manifest['run_id'] == manifest['run_id']: # delivered again
+            return
+        if not is_later_run(new_manifest):
+            print(f'Ignoring manifest of earlier run {new_manifest["run_id"]}')
+            superseded_runs.add(new_manifest['run_id'])
+            return
+        print(f'Run {new_manifest["run_id"]} replaces run {manifest["run_id"]}, dropping what was merged for it')
+        superseded_runs.add(manifest['run_id'])
+        reset_run()
+    manifest = new_manifest
+    print(f'Received manifest of run {manifest["run_id"]} with {manifest["num_tasks"]} tasks')
+    if manifest.get('config', config_id) != config_id:
+        print(f'Warning: the run was made with configuration {manifest["config"]}, the outputter has {config_id}')
+    read_cached(manifest)
+    read_skims(manifest)
+    release_held(ch) # messages that arrived before the manifest
+    check_run_complete(ch) # the tasks may all have arrived already
+
+### Put a failed message back in its queue with its retry count, or drop it after max_retries
+# the original message is acknowledged either way
+def retry_or_drop(channel, delivery_tag, properties, body, queue):
+    retries = (properties.headers or {}).get('x-retries', 0) if properties else 0
+    if retries < max_retries:
+        channel.basic_publish(exchange='', routing_key=queue, body=body,
+                              properties=pika.BasicProperties(headers={'x-retries': retries + 1}))
+        print(f'Requeued message, retry {retries + 1} of {max_retries}')
+    else:
+        print(f'Dropping message after {max_retries} retries')
+    channel.basic_ack(delivery_tag=delivery_tag)
 
 # Callback function for receiving messages
 def callback(ch, method, properties, body):
-    try:
-        # Decompress the data
-        segment = json.loads(zlib.decompress(body).decode('utf-8'))
-        process_segment(segment)
+    handle_message(ch, method.delivery_tag, properties, body)
 
-        print(f'processed {segment["sample"]}')
+### Merge, hold or drop a message
+# held messages stay unacknowledged, so they go back in the queue if the outputter stops first
+def handle_message(ch, delivery_tag, properties, body):
+    try:
+        # Decode the data
+        header, data = wire.decode(body)
+        action = message_action(header)
+        if action == 'hold':
+            held_messages.append((delivery_tag, properties, body))
+            return
+        if action == 'drop':
+            print(f'Ignoring message from earlier run {header["run_id"]}')
+            ch.basic_ack(delivery_tag=delivery_tag)
+            return
+        if is_duplicate(header):
+            print(f'Ignoring message {header["seq"]} of task {header["task_id"]}, already merged')
+            ch.basic_ack(delivery_tag=delivery_tag)
+            return
+        track_message(header, data, body) # merged once all the messages of the task have arrived
+        # acknowledge the message only once it has been merged or kept with its task
+        ch.basic_ack(delivery_tag=delivery_tag)
+
+        print(f'processed {header["sample"]}')
+        check_run_complete(ch)
     except Exception as e:
         print(f'Error processing message: {e}')
+        retry_or_drop(ch, delivery_tag, properties, body, 'processed_data')
        # if isinstance(segment, list):
         #    segment = segment[0]
 
@@ -101,51 +333,36 @@ def callback(ch, method, properties, body):
         #     process_segment(segment)
 
 
-# Connect to RabbitMQ
-connection = rabbitmq_connect('rabbitmq')
-channel = connection.channel()  
-channel.queue_declare(queue='processed_data')   
-channel.basic_consume(queue='processed_data', on_message_callback=callback, auto_ack=True)
-
-# Wait for messages
-print('Waiting for messages. To exit press CTRL+C')
-try: 
-    channel.start_consuming()
-except KeyboardInterrupt:
-    print('Interrupted')
-finally:
-    connection.close()
-    
-# Plot the merged data
-def plot_data(merged_data):
-    xmin = 80 * GeV
-    xmax = 250 * GeV
-    step_size = 5 * GeV
-
-    bin_edges = np.arange(start=xmin, # The interval includes this value
-                                            stop=xmax+step_size, # The interval doesn't include this value
-                                            step=step_size ) # Spacing between values
-    bin_centres = np.arange(start=xmin+step_size/2, # The interval includes this value
-                                            stop=xmax+step_size/2, # The interval doesn't include this value
-                                            step=step_size ) # Spacing between values
-
-    data_x,_ = np.histogram(ak.to_numpy(merged_data['data']['mllll']), 
-                                                 bins=bin_edges ) # histogram the data
+### Histogram the merged events into the merged histograms
+# each array is histogrammed on its own, so nothing needs to be concatenated
+def histogram_events(merged_data):
+    for s in merged_data:
+        hist = Histogram(bin_edges)
+        for data in merged_data[s]:
+            mllll = ak.to_numpy(data['mllll'])
+            if 'totalWeight' in data.fields: # Monte Carlo
+                hist.fill(mllll, ak.to_numpy(data.totalWeight))
+            else: # data events are not weighted
+                hist.fill(mllll)
+        add_histogram(s, hist)
+
+# Plot the merged histograms
+def plot_data(merged_hists):
+    data_x = merged_hists['data'].sumw # histogram of the data
     data_x_errors = np.sqrt( data_x ) # statistical error on the data
 
-    signal_x = ak.to_numpy(merged_data[r'Signal ($m_H$ = 125 GeV)']['mllll']) # histogram the signal
-    signal_weights = ak.to_numpy(merged_data[r'Signal ($m_H$ = 125 GeV)'].totalWeight) # get the weights of the signal events
+    signal_heights = merged_hists[r'Signal ($m_H$ = 125 GeV)'].sumw # histogram of the signal
     signal_color = samples[r'Signal ($m_H$ = 125 GeV)']['color'] # get the colour for the signal bar
 
-    mc_x = [] # define list to hold the Monte Carlo histogram entries
-    mc_weights = [] # define list to hold the Monte Carlo weights
+    mc_heights_list = [] # define list to hold the Monte Carlo histograms
+    mc_sumw2 = np.zeros(len(bin_centres)) # define array to hold the Monte Carlo sums of weights squared
     mc_colors = [] # define list to hold the colors of the Monte Carlo bars
     mc_labels = [] # define list to hold the legend labels of the Monte Carlo bars
 
     for s in samples: # loop over samples
         if s not in ['data', r'Signal ($m_H$ = 125 GeV)']: # if not data nor signal
-            mc_x.append( ak.to_numpy(merged_data[s]['mllll']) ) # append to the list of Monte Carlo histogram entries
-            mc_weights.append( ak.to_numpy(merged_data[s].totalWeight) ) # append to the list of Monte Carlo weights
+            mc_heights_list.append( merged_hists[s].sumw ) # append to the list of Monte Carlo histograms
+            mc_sumw2 += merged_hists[s].sumw2 # add to the Monte Carlo sums of weights squared
             mc_colors.append( samples[s]['color'] ) # append to the list of Monte Carlo bar colors
             mc_labels.append( s ) # append to the list of Monte Carlo legend labels
     
@@ -161,19 +378,19 @@ def plot_data(merged_data):
                                         fmt='ko', # 'k' means black and 'o' is for circles 
                                         label='Data') 
     
-    # plot the Monte Carlo bars
-    mc_heights = main_axes.hist(mc_x, bins=bin_edges, 
-                                weights=mc_weights, stacked=True, 
+    # plot the Monte Carlo bars, one entry per bin centre weighted by the bin height
+    mc_heights = main_axes.hist([bin_centres]*len(mc_heights_list), bins=bin_edges, 
+                                weights=mc_heights_list, stacked=True, 
                                 color=mc_colors, label=mc_labels )
     
     mc_x_tot = mc_heights[0][-1] # stacked background MC y-axis value
     
     # calculate MC statistical uncertainty: sqrt(sum w^2)
-    mc_x_err = np.sqrt(np.histogram(np.hstack(mc_x), bins=bin_edges, weights=np.hstack(mc_weights)**2)[0])
+    mc_x_err = np.sqrt(mc_sumw2)
     
     # plot the signal bar
-    main_axes.hist(signal_x, bins=bin_edges, bottom=mc_x_tot, 
-                                 weights=signal_weights, color=signal_color,
+    main_axes.hist(bin_centres, bins=bin_edges, bottom=mc_x_tot, 
+                                 weights=signal_heights, color=signal_color,
                                  label=r'Signal ($m_H$ = 125 GeV)')
     
     # plot the statistical uncertainty
@@ -242,7 +459,43 @@ def plot_data(merged_data):
     
     pass
 
-# Call the function to plot the data
-plot_data(merged_data)
-plt.show()
-
+### Write a summary of the run next to the plot
+def write_summary(path):
+    summary = {'run_id': manifest['run_id'] if manifest else None,
+               'num_tasks': manifest['num_tasks'] if manifest else None,
+               'completed_tasks': len(completed_tasks),
+               'missing_tasks': missing_tasks(),
+               'samples': {s: {'sum_of_weights': float(merged_hists[s].sumw.sum()),
+                               'error': float(np.sqrt(merged_hists[s].sumw2.sum()))} for s in merged_hists}}
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=1)
+    print(json.dumps(summary, indent=1))
+
+if __name__ == '__main__':
+    # Connect to RabbitMQ
+    connection = rabbitmq_connect(settings['broker']['host'])
+    channel = connection.channel()  
+    channel.queue_declare(queue='processed_data')   
+    channel.queue_declare(queue='run_manifest', durable=True) # declared durable by the producer
+    channel.basic_qos(prefetch_count=prefetch_count)
+    channel.basic_consume(queue='run_manifest', on_message_callback=manifest_callback, auto_ack=False)
+    channel.basic_consume(queue='processed_data', on_message_callback=callback, auto_ack=False)
+    connection.call_later(run_timeout, on_timeout)
+
+    # Wait for messages until all tasks of the run have arrived
+    print('Waiting for messages. To exit press CTRL+C')
+    try: 
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        print('Interrupted')
+    finally:
+        connection.close()
+
+    # Call the function to plot the data
+    histogram_events(merged_data)
+    for s in samples: # samples with no events still need an (empty) histogram
+        merged_hists.setdefault(s, Histogram(bin_edges))
+    plot_data(merged_hists)
+    os.makedirs(output_dir, exist_ok=True)
+    plt.savefig(os.path.join(output_dir, 'mllll.png'))
+    write_summary(os.path.join(output_dir, 'summary.json'))
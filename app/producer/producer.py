@@ -2,51 +2,20 @@ import uproot # for reading .root files
 import awkward as ak # to represent nested data in columnar format
 import time # to measure time to analyse
 import pika # for rabbitMQ
-import infofile # local file containing cross-sections, sums of weights, dataset IDs
+import infostore # table of cross-sections, sums of weights, dataset IDs generated from infofile.py
 import json
 import os
+import uuid # for the run id
+import fileindex # index of the input files, cached between runs
+import skimstore # Parquet store of the events passing the selection
+import ledger # fingerprints of the tasks completed in earlier runs
+from selection import (cut_branches, kinematic_branches, weight_branches, selection_hash,
+                       code_hash, result_code) # shared with the consumers
+from config import settings, config_id, lumi, fraction, tuple_path, samples # shared pipeline configuration
 
-lumi = 10 # fb-1 # data_A,data_B,data_C,data_D
-fraction = 1.0 # reduce this is if you want the code to run quicker                                                                                                                         
-#tuple_path = "Input/4lep/" # local 
-tuple_path = "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/" # web address
-# Define number of workers to be used
-number_workers = 2
 
-
-    
-
-
-samples = {
-
-    'data': {
-        'list' : ['data_A','data_B','data_C','data_D'],
-    },
-
-    r'Background $Z,t\bar{t}$' : { # Z + ttbar
-        'list' : ['Zee','Zmumu','ttbar_lep'],
-        'color' : "#6b59d3" # purple
-    },
-
-    r'Background $ZZ^*$' : { # ZZ
-        'list' : ['llll'],
-        'color' : "#ff0000" # red
-    },
-
-    r'Signal ($m_H$ = 125 GeV)' : { # H -> ZZ -> llll
-        'list' : ['ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep'],
-        'color' : "#00cdff" # light blue
-    },
-
-}
-
-
-### Units ###
-#MeV = 0.001
-#GeV = 1.0
-
-# Get RabbitMQ hostname from environment variable
-rabbitmq_host = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+# Get RabbitMQ hostname from the configuration
+rabbitmq_host = settings['broker']['host']
 
 # Define rabbitMQ connection
 def rabbitmq_connection(host, retries=10, delay=5):
@@ -58,27 +27,132 @@ def rabbitmq_connection(host, retries=10, delay=5):
             time.sleep(delay)
     raise Exception(f"Failed to connect to {host} after {retries} retries")
 
-##Get data
+# Identifier of this run, sent with every task so the outputter can tell runs apart
+run_id = os.getenv('RUN_ID') or uuid.uuid4().hex[:12]
+# Time the run started, so the outputter can tell an earlier run from a later one
+run_created = time.time()
+# Number of entries in each task sent to the consumers
+entries_per_task = settings['producer']['entries_per_task']
+# File caching the index of the input files between runs
+file_index_path = settings['producer']['file_index']
+# Branches read by the consumers, the index keeps their basket boundaries and sizes
+event_branches = cut_branches + kinematic_branches
+read_branches = event_branches + weight_branches # weights are not read for data
+# hash of the selection, tasks with a skim made with the same selection are not sent to the consumers
+selection_id = selection_hash(settings)
+# hash of the consumer code, tasks whose result in the ledger was made with other code are sent again
+code_id = code_hash(result_code)
+# Number of tasks published before waiting for the broker to confirm them
+publish_window = settings['producer']['publish_window']
+
+### File name of a task
+def file_url(task):
+    return tuple_path+task['prefix']+task['sample']+".4lep.root"
+
+### Branches read by the consumer of a task
+def task_branches(task):
+    return event_branches if 'data' in task['sample'] else read_branches
 
-def get_data_from_files(samples):
+##Get data
 
-    fields = [] # define empty list to hold awkward arrays
+### Get number of entries in a file
+def get_num_entries(prefix, val):
+    fileString = tuple_path+prefix+val+".4lep.root" # file name to open
+    try:
+        with uproot.open(fileString + ":mini") as tree:
+            return tree.num_entries # only reads the file header, not the branches
+    except Exception as e:
+        if val in infostore.infos: # fall back to the number of events in the metadata table
+            print(f"Failed to read number of entries from {fileString}, using the metadata table: {e}")
+            return infostore.infos[val]["events"]
+        raise
+
+### Split a file into entry ranges
+def split_entries(num_entries, entries_per_task):
+    ranges = [] # list of (entry_start, entry_stop) pairs
+    for entry_start in range(0, num_entries, entries_per_task):
+        ranges.append((entry_start, min(entry_start + entries_per_task, num_entries)))
+    return ranges
+
+### Make the tasks of every file, split on basket boundaries using the file index
+def get_data_from_files(samples, file_index):
+
+    tasks = [] # define empty list to hold tasks
     for s in samples: # loop over samples
         for val in samples[s]['list']: # loop over each file
             if s == 'data': 
                 prefix = "Data/" # Data prefix
             else: # MC prefix
-                prefix = "MC/mc_"+str(infofile.infos[val]["DSID"])+"."
-
-            field=prefix+' '+val
-            fields.append(field) # append file name to list of fields
-           # fileString = tuple_path+prefix+val+".4lep.root" # file name to open
-            #temp = read_file(fileString,val) # call the function read_file defined below
-            #frames.append(temp) # append array returned from read_file to list of awkward arrays
-        #data[s] = ak.concatenate(frames) # dictionary entry is concatenated awkward arrays
-    return fields # return list of fields to send to consumers
-
-field_list = get_data_from_files(samples)
+                prefix = "MC/mc_"+str(infostore.infos[val]["DSID"])+"."
+
+            fileString = tuple_path+prefix+val+".4lep.root"
+            entry = fileindex.lookup(file_index, fileString, read_branches) # only probes new or changed files
+            if entry is not None:
+                num_entries = int(entry['num_entries'] * fraction) # process up to numevents*fraction
+                ranges = fileindex.split_aligned(num_entries, entries_per_task, entry['common_offsets'])
+            else: # not indexed, split without the basket boundaries
+                num_entries = int(get_num_entries(prefix, val) * fraction)
+                ranges = split_entries(num_entries, entries_per_task)
+            version = entry['version'] if entry is not None else None # ETag or size and modification time
+            for entry_start, entry_stop in ranges:
+                tasks.append({'run_id': run_id,
+                              'run_created': run_created, # sent back by the consumers with the results
+                              'task_id': f"{val}:{entry_start}-{entry_stop}",
+                              'prefix': prefix,
+                              'sample': val,
+                              'entry_start': entry_start,
+                              'entry_stop': entry_stop, # one task per entry range
+                              'config': config_id, # consumers refuse tasks made with another configuration
+                              # the consumers store the skims under the input file's version
+                              'source': skimstore.source_id(fileString, version),
+                              'fingerprint': ledger.fingerprint(fileString, version, entry_start, entry_stop,
+                                                                code_id, config_id)})
+    return tasks # return list of tasks to send to consumers
+
+### Estimate the cost of a task from the compressed size of the baskets it reads
+def estimate_cost(task, file_index):
+    entries = task['entry_stop'] - task['entry_start']
+    entry = file_index.get(file_url(task))
+    if entry is not None:
+        return fileindex.range_bytes(entry, task_branches(task), task['entry_start'], task['entry_stop'])
+    # file not indexed, use the average size of an entry in the indexed files
+    indexed = [e for e in file_index.values() if e['num_entries'] > 0]
+    if not indexed:
+        return entries
+    return entries * (sum(fileindex.range_bytes(e, read_branches, 0, e['num_entries']) for e in indexed)
+                      / sum(e['num_entries'] for e in indexed))
+
+### Order tasks so the most expensive are sent first (longest processing time first)
+def schedule_tasks(tasks, file_index):
+    for task in tasks:
+        task['cost'] = estimate_cost(task, file_index)
+    return sorted(tasks, key=lambda task: task['cost'], reverse=True)
+
+file_index = fileindex.load(file_index_path)
+field_list = schedule_tasks(get_data_from_files(samples, file_index), file_index)
+fileindex.save(file_index_path, file_index)
+
+### Split the tasks into those to send to the consumers, those whose messages the outputter kept
+# in the ledger and those already skimmed with this selection
+# a skim is only used if it was made from the same version of the input file, and not when the
+# ledger shows that the task's other inputs have changed since it was made
+def split_cached(field_list, run_ledger):
+    to_send, cached, skimmed = [], [], []
+    for task in field_list:
+        record = run_ledger.get(task['task_id'])
+        if ledger.is_fresh(run_ledger, task['task_id'], task['fingerprint']):
+            cached.append({k: task[k] for k in ['task_id', 'sample', 'fingerprint']})
+        elif ((record is None or record['fingerprint'] == task['fingerprint'])
+              and skimstore.exists(selection_id, task['sample'], task['entry_start'], task['entry_stop'], task['source'])):
+            skimmed.append({k: task[k] for k in ['task_id', 'sample', 'entry_start', 'entry_stop', 'source']})
+        else:
+            to_send.append(task)
+    if cached or skimmed:
+        print(f"{len(cached)} of {len(field_list)} tasks unchanged since an earlier run, "
+              f"{len(skimmed)} already skimmed with selection {selection_id}")
+    return to_send, cached, skimmed
+
+field_list, cached, skimmed = split_cached(field_list, ledger.load())
 
 
 ## Segmenting data
@@ -108,19 +182,45 @@ field_list = get_data_from_files(samples)
 
 connection = rabbitmq_connection(rabbitmq_host) 
 
-def send_data_to_consumers(field_list):
-    connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+### Manifest of the run, so the outputter knows when every task has been processed
+# the outputter reads the cached and skimmed tasks from the ledger and the skim store itself
+def make_manifest(field_list, cached, skimmed):
+    return {'run_id': run_id,
+            'created': run_created,
+            'task_ids': [task['task_id'] for task in field_list + cached + skimmed],
+            'num_tasks': len(field_list) + len(cached) + len(skimmed),
+            'selection': selection_id,
+            'config': config_id,
+            'cached': cached,
+            'skimmed': skimmed}
+
+### Publish the manifest and the tasks on one channel, the broker confirms each window of tasks at once
+# queues are durable and messages persistent so that a broker restart does not lose the run
+def send_data_to_consumers(connection, field_list, cached, skimmed):
     channel = connection.channel()
-    channel.queue_declare(queue='segmented_data')
-    for segment in field_list:
-        channel.basic_publish(exchange='', routing_key='segmented_data', body=segment)
-    
-        print(f"Sent {segment}")# send each segment to consumers
-    print("All data sent")
+    channel.queue_declare(queue='segmented_data', durable=True)
+    channel.queue_declare(queue='run_manifest', durable=True)
+    persistent = pika.BasicProperties(delivery_mode=2)
+    channel.tx_select() # tx_commit returns once the broker has taken every message published since the last one
+    start = time.time()
+    # send the manifest to the outputter before any of the tasks
+    channel.basic_publish(exchange='', routing_key='run_manifest', body=json.dumps(make_manifest(field_list, cached, skimmed)),
+                          properties=persistent)
+    print(f"Sent manifest of run {run_id} with {len(field_list) + len(cached) + len(skimmed)} tasks, "
+          f"{len(cached)} cached and {len(skimmed)} skimmed")
+    for i, segment in enumerate(field_list, 1):
+        channel.basic_publish(exchange='', routing_key='segmented_data', body=json.dumps(segment),
+                              properties=persistent) # send each segment to consumers
+        if i % publish_window == 0:
+            channel.tx_commit()
+            print(f"Sent {i} of {len(field_list)} tasks")
+    channel.tx_commit()
+    elapsed = time.time() - start
+    print(f"All data sent: {len(field_list)} tasks in {elapsed:.2f} s ({len(field_list)/max(elapsed, 1e-9):.0f} tasks/s)")
     connection.close()
     #return
 
-send_data_to_consumers(field_list) 
+send_data_to_consumers(connection, field_list, cached, skimmed)
 
 #def process_data():
  #   data = get_data_from_files()
@@ -0,0 +1,74 @@
+"""Event selection shared by the services, and hashes of it and of the consumer code
+
+The hash of the selection identifies the skims made with it, and the hash of the consumer code is
+part of the fingerprint of every task in the run ledger.
+"""
+
+import hashlib
+import json
+import os
+
+# Increase when something outside the hashed files changes the columns of the skims (mllll, totalWeight),
+# e.g. a new version of vector, so that skims made with the old calculation are not used
+skim_version = 1
+
+# Files the columns of the skims depend on: the selection and the consumer calculating mllll and totalWeight
+skim_code = ['selection.py', 'consumer.py']
+# Files the messages kept in the run ledger depend on
+result_code = skim_code + ['fastloop.py', 'histogram.py', 'wire.py']
+# Consumer settings the columns of the skims depend on
+skim_settings = ['mass_engine', 'weight_engine']
+# Directories holding the code files: next to this module in the containers, or in the consumer's
+# directory in the repository
+here = os.path.dirname(os.path.abspath(__file__))
+code_dirs = [here, os.path.join(here, 'consumer')]
+
+# cut on lepton charge
+# paper: "selecting two pairs of isolated leptons, each of which is comprised of two leptons with the same flavour and opposite charge"
+def cut_lep_charge(lep_charge):
+# throw away when sum of lepton charges is not equal to 0
+# first lepton in each event is [:, 0], 2nd lepton is [:, 1] etc
+    return lep_charge[:, 0] + lep_charge[:, 1] + lep_charge[:, 2] + lep_charge[:, 3] != 0
+
+# cut on lepton type
+# paper: "selecting two pairs of isolated leptons, each of which is comprised of two leptons with the same flavour and opposite charge"
+def cut_lep_type(lep_type):
+# for an electron lep_type is 11
+# for a muon lep_type is 13
+# throw away when none of eeee, mumumumu, eemumu
+    sum_lep_type = lep_type[:, 0] + lep_type[:, 1] + lep_type[:, 2] + lep_type[:, 3]
+    return (sum_lep_type != 44) & (sum_lep_type != 48) & (sum_lep_type != 52)
+
+# branches read first to apply the cuts on lepton charge and type
+cut_branches = ['lep_charge','lep_type']
+# branches only read for the entries that pass the cuts
+kinematic_branches = ['lep_pt','lep_eta','lep_phi','lep_E'] # add more variables here if you make cuts on them 
+weight_branches = ['mcWeight','scaleFactor_PILEUP',
+                   'scaleFactor_ELE','scaleFactor_MUON',
+                   'scaleFactor_LepTRIGGER'] # variables to calculate Monte Carlo weight
+
+
+### Path of a code file, every service that hashes the code needs a copy of the files
+def code_path(name):
+    for directory in code_dirs:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f'Code file {name} not found in {code_dirs}')
+
+
+### Hash of code files and of the parameters the results depend on
+def code_hash(files, **parameters):
+    digest = hashlib.sha256()
+    for name in files:
+        with open(code_path(name), 'rb') as f:
+            digest.update(name.encode('utf-8') + b'\0' + f.read())
+    digest.update(json.dumps(parameters, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+### Hash of the selection, the consumer code and the settings the skimmed columns depend on
+# any change to the cuts, the branches read, the mass or weight calculation, lumi or skim_version gives a new hash
+def selection_hash(settings):
+    return code_hash(skim_code, lumi=settings['analysis']['lumi'],
+                     **{key: settings['consumer'][key] for key in skim_settings})
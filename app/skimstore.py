@@ -0,0 +1,118 @@
+"""On-disk store of the events passing the selection, one Parquet file per task
+
+Skims are kept in a directory per selection hash (see selection.py), named by sample, entry range
+and a hash of the input file's url and version (ETag or size and modification time), so a run with
+the same selection, tasks and input files can read them instead of processing the files.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import awkward as ak
+import numpy as np
+
+try:
+    import pyarrow.parquet as pq
+except ImportError: # only the consumers write skims, the producer only checks for them
+    pq = None
+
+from config import settings
+
+# Directory holding the skims, skimming is turned off when this is empty
+skim_dir = settings['cache']['skim_dir'] or None
+enabled = bool(skim_dir)
+
+
+### Hash of the input file of a skim, its url and version as given by fileindex.file_version
+# None when the version is unknown, such a skim could not be checked against the file and is not kept
+def source_id(url, version):
+    if version is None:
+        return None
+    return hashlib.sha256(json.dumps([url, version], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+### Path of the skim of an entry range of a sample
+def skim_path(selection, sample, entry_start, entry_stop, source):
+    return os.path.join(skim_dir, selection, f'{sample}_{entry_start}-{entry_stop}_{source}.parquet')
+
+
+### Check if an entry range of this version of the input file has been skimmed
+def exists(selection, sample, entry_start, entry_stop, source):
+    return (enabled and source is not None
+            and os.path.exists(skim_path(selection, sample, entry_start, entry_stop, source)))
+
+
+### Write the events of an entry range batch by batch, so the skim is never held in memory whole
+# the batches go to a temporary file that is renamed once the skim is complete, so a skim is never
+# read half written, and a skim that fails to write is dropped without stopping the task
+# used as a context manager, the skim is completed at the end of the block or dropped on an exception
+class Writer:
+
+    def __init__(self, selection, sample, entry_start, entry_stop, source, enabled=True):
+        enabled = enabled and source is not None
+        self.path = skim_path(selection, sample, entry_start, entry_stop, source) if enabled else None
+        self.enabled = enabled # a disabled writer ignores everything
+        self.tmp_path = None
+        self.writer = None # opened with the schema of the first batch
+        self.failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, array):
+        if not self.enabled or self.failed:
+            return
+        try:
+            if pq is None:
+                raise ImportError('pyarrow is needed to write skims')
+            table = ak.to_arrow_table(ak.to_packed(array), extensionarray=False)
+            if self.writer is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.part')
+                os.close(fd)
+                self.writer = pq.ParquetWriter(self.tmp_path, table.schema)
+            self.writer.write_table(table)
+        except (OSError, ImportError) as e: # the task's result is still sent to the outputter
+            print(f'Failed to write skim {self.path}: {e}')
+            self.abort()
+
+    ### Rename the complete skim into place, returns its path or None if it failed
+    def close(self):
+        if not self.enabled:
+            return None
+        if self.writer is None: # Parquet needs a type, an empty mllll column stands for no events
+            self.write(ak.zip({'mllll': np.empty(0)}))
+        if self.failed:
+            return None
+        try:
+            self.writer.close()
+            os.replace(self.tmp_path, self.path)
+        except OSError as e:
+            print(f'Failed to write skim {self.path}: {e}')
+            self.abort()
+            return None
+        return self.path
+
+    ### Remove the temporary file of a skim that will not be completed
+    def abort(self):
+        self.failed = True
+        try:
+            if self.writer is not None:
+                self.writer.close()
+        except OSError:
+            pass
+        if self.tmp_path is not None and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+### Read the events of an entry range
+def read(selection, sample, entry_start, entry_stop, source):
+    return ak.from_parquet(skim_path(selection, sample, entry_start, entry_stop, source))
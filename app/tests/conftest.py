@@ -0,0 +1,110 @@
+"""Fixtures shared by the tests: a small ROOT file like the 4-lepton files, and a local HTTP server
+
+The services import their shared modules by name, as they are copied next to each other in the
+containers, so the app directory and the service directories are put on the path.
+"""
+
+import functools
+import http.server
+import io
+import os
+import sys
+import threading
+
+import awkward as ak
+import numpy as np
+import pytest
+import uproot
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [app_dir, os.path.join(app_dir, 'consumer'), os.path.join(app_dir, 'outputter')]
+
+from selection import cut_branches, kinematic_branches, weight_branches
+
+
+### Write a file with the branches the consumers read, in several baskets
+def make_root_file(path, num_entries=4000, basket_entries=500, seed=0):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(4, 6, num_entries) # leptons per event
+    total = int(counts.sum())
+    pt = rng.uniform(7e3, 100e3, total).astype(np.float32)
+    eta = rng.uniform(-2.5, 2.5, total).astype(np.float32)
+    lep_type = rng.choice(np.array([11, 13], np.uint32), total)
+    lep_mass = np.where(lep_type == 11, 0.511, 105.7)
+    leptons = {'lep_pt': pt, 'lep_eta': eta,
+               'lep_phi': rng.uniform(-np.pi, np.pi, total).astype(np.float32),
+               'lep_E': np.sqrt((pt * np.cosh(eta))**2 + lep_mass**2).astype(np.float32),
+               'lep_charge': rng.choice(np.array([-1, 1], np.int32), total),
+               'lep_type': lep_type}
+    branches = {name: ak.unflatten(values, counts) for name, values in leptons.items()}
+    for name in weight_branches:
+        branches[name] = rng.normal(1, 0.05, num_entries).astype(np.float32)
+    with uproot.recreate(path) as f:
+        tree = f.mktree('mini', {name: ak.type(branches[name][:0]).content for name in branches})
+        for start in range(0, num_entries, basket_entries): # one basket per branch each time
+            tree.extend({name: branches[name][start:start + basket_entries] for name in branches})
+    return path
+
+
+@pytest.fixture(scope='session')
+def root_file(tmp_path_factory):
+    return make_root_file(str(tmp_path_factory.mktemp('files') / 'mc_000000.test.4lep.root'))
+
+
+@pytest.fixture
+def read_branches():
+    return cut_branches + kinematic_branches + weight_branches
+
+
+### Static file handler answering byte-range requests with 206, one range or several in a multipart
+# response, like the Open Data server
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    boundary = 'RANGE_BOUNDARY'
+
+    def send_head(self):
+        byte_range = self.headers.get('Range')
+        if byte_range is None:
+            return super().send_head()
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        ranges = []
+        for part in byte_range.split('=')[1].split(','):
+            start, stop = part.strip().split('-')
+            ranges.append((int(start), min(int(stop), len(data) - 1)))
+        self.send_response(206)
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            body = data[start:stop + 1]
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Range', f'bytes {start}-{stop}/{len(data)}')
+        else:
+            body = b''.join(f'--{self.boundary}\r\nContent-Type: application/octet-stream\r\n'
+                            f'Content-Range: bytes {start}-{stop}/{len(data)}\r\n\r\n'.encode() +
+                            data[start:stop + 1] + b'\r\n' for start, stop in ranges)
+            body += f'--{self.boundary}--\r\n'.encode()
+            self.send_header('Content-Type', f'multipart/byteranges; boundary={self.boundary}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def log_message(self, format, *args):
+        self.server.requests.append((self.command, self.headers.get('Range')))
+
+
+### Serve a directory over HTTP on a free local port
+@pytest.fixture
+def http_server(tmp_path):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             functools.partial(RangeHandler, directory=str(tmp_path)))
+    server.requests = [] # (method, Range header) of every request
+    server.directory = tmp_path
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,148 @@
+"""Calculations of the consumer on the events of a small ROOT file"""
+
+import concurrent.futures
+import json
+import os
+import tracemalloc
+
+import awkward as ak
+import numpy as np
+import pyarrow.parquet as pq
+import pytest
+import uproot
+
+import consumer
+import skimstore
+import wire
+from conftest import make_root_file
+from histogram import Histogram
+from selection import cut_branches, kinematic_branches, weight_branches
+
+
+@pytest.fixture
+def leptons(root_file):
+    with uproot.open(root_file + ':mini') as tree:
+        return tree.arrays(kinematic_branches, library='ak')
+
+
+def test_numpy_mass_matches_vector(leptons):
+    mass = consumer.calc_mllll_numpy(leptons.lep_pt, leptons.lep_eta, leptons.lep_phi, leptons.lep_E)
+    expected = ak.to_numpy(consumer.calc_mllll(leptons.lep_pt, leptons.lep_eta, leptons.lep_phi, leptons.lep_E))
+    # vector calculates in float32
+    assert np.allclose(mass, expected, rtol=1e-4, atol=1e-2)
+
+
+def test_mass_check_reports_without_failing(leptons, monkeypatch, capsys):
+    monkeypatch.setattr(consumer, 'mass_engine', 'numpy')
+    monkeypatch.setattr(consumer, 'check_mass', True)
+    mass = consumer.calc_mllll_engine(leptons.lep_pt, leptons.lep_eta, leptons.lep_phi, leptons.lep_E)
+    assert np.array_equal(mass, consumer.calc_mllll_numpy(leptons.lep_pt, leptons.lep_eta,
+                                                          leptons.lep_phi, leptons.lep_E))
+    assert 'numpy mass differs from vector by up to' in capsys.readouterr().out
+
+
+### Temporary memory allocated by a weight engine: the peak traced memory above the size of its result
+def temporary_bytes(calc_weight, events):
+    calc_weight(2.0, events) # first call allocates anything cached
+    tracemalloc.start()
+    result = calc_weight(2.0, events)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - ak.to_numpy(result).nbytes, result
+
+
+def test_numpy_weights_only_allocate_the_result():
+    rng = np.random.default_rng(0)
+    events = ak.zip({name: rng.normal(1, 0.05, 100000).astype(np.float32) for name in weight_branches})
+    temporary, weights = temporary_bytes(consumer.calc_weight_numpy, events)
+    assert temporary < 0.25 * weights.nbytes
+    # one float32 array per product
+    temporary_awkward, expected = temporary_bytes(consumer.calc_weight, events)
+    assert temporary_awkward > 0.5 * ak.to_numpy(expected).nbytes
+    # calc_weight multiplies in float32
+    assert weights.dtype == np.float64
+    assert np.allclose(weights, ak.to_numpy(expected), rtol=1e-5)
+
+
+def test_streamed_batches_are_skimmed_batch_by_batch(tmp_path, monkeypatch):
+    make_root_file(str(tmp_path / 'data_test.4lep.root'))
+    monkeypatch.setattr(skimstore, 'skim_dir', str(tmp_path / 'skims'))
+    monkeypatch.setattr(skimstore, 'enabled', True)
+    for name, value in [('consumer_mode', 'events'), ('stream_batches', True), ('event_engine', 'awkward'),
+                        ('iterate_step', 1000), ('adaptive_step', False), ('log_batches', False)]:
+        monkeypatch.setattr(consumer, name, value)
+    task = {'task_id': 'data_test:0-4000', 'prefix': '', 'sample': 'data_test', 'entry_start': 0, 'entry_stop': 4000,
+            'source': 'abc'}
+    messages = [wire.decode(body) for body in consumer.process_segment(json.dumps(task).encode('utf-8'),
+                                                                        str(tmp_path) + '/')]
+    sent = [data for _, data in messages if data is not None]
+    assert len(sent) == 4
+    skim = skimstore.skim_path(consumer.selection_id, 'data_test', 0, 4000, 'abc')
+    assert pq.ParquetFile(skim).num_row_groups == len(sent) # one row group per batch
+    assert ak.array_equal(skimstore.read(consumer.selection_id, 'data_test', 0, 4000, 'abc'), ak.concatenate(sent))
+
+
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_byte_step_counts_every_branch_read(root_file, read_branches, monkeypatch, adaptive):
+    for name, value in [('iterate_step', '50 kB'), ('adaptive_step', adaptive), ('min_step', 1),
+                        ('log_batches', False)]:
+        monkeypatch.setattr(consumer, name, value)
+    with uproot.open(root_file + ':mini') as tree:
+        expected = tree.num_entries_for('50 kB', read_branches)
+        assert expected < tree.num_entries_for('50 kB', cut_branches)
+        sizes = [len(data) for data, _ in consumer.iterate_batches(tree, cut_branches, 0, tree.num_entries,
+                                                                   read_branches=read_branches)]
+    assert sum(sizes) == 4000
+    if adaptive: # batches end on the first basket boundary at or after the step
+        assert sizes[0] == min(-(-expected // 500) * 500, 4000)
+    else:
+        assert sizes[0] == expected
+
+
+### Channel recording what the consumer publishes and acknowledges
+class Channel:
+    def __init__(self):
+        self.published = []
+        self.acked = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((routing_key, properties.headers if properties else None))
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+def test_task_of_a_dead_worker_is_retried(monkeypatch):
+    monkeypatch.setattr(consumer, 'worker_processes', 1)
+    executor = consumer.start_workers(1)
+    workers = {'executor': executor}
+    future = executor.submit(os._exit, 1) # the worker dies as if killed
+    concurrent.futures.wait([future])
+    channel = Channel()
+    consumer.pool_done(channel, 7, None, b'task', future, workers, executor)
+    assert channel.published == [('segmented_data', {'x-retries': 1})]
+    assert channel.acked == [7]
+    assert workers['executor'] is not executor # the workers were started again
+    assert workers['executor'].submit(abs, -2).result() == 2
+    workers['executor'].shutdown()
+
+
+@pytest.mark.skipif(not consumer.fastloop.available, reason='numba is not installed')
+@pytest.mark.parametrize('sample', ['data_test', 'ggH125_ZZ4lep'])
+def test_numba_engine_fills_the_same_histogram(tmp_path, monkeypatch, sample):
+    make_root_file(str(tmp_path / f'{sample}.4lep.root'), num_entries=20000, basket_entries=2500)
+    for name, value in [('consumer_mode', 'histogram'), ('iterate_step', 5000), ('adaptive_step', False),
+                        ('log_batches', False)]:
+        monkeypatch.setattr(consumer, name, value)
+    task = json.dumps({'task_id': f'{sample}:0-20000', 'prefix': '', 'sample': sample,
+                       'entry_start': 0, 'entry_stop': 20000}).encode('utf-8')
+    hists = {}
+    for engine in ['awkward', 'numba']:
+        monkeypatch.setattr(consumer, 'event_engine', engine)
+        (header, _), = [wire.decode(body) for body in consumer.process_segment(task, str(tmp_path) + '/')]
+        hists[engine] = Histogram.from_bytes(header['payload'])
+    assert hists['awkward'].sumw.sum() > 0
+    assert np.array_equal(hists['numba'].edges, hists['awkward'].edges)
+    # the awkward engine multiplies the weights in float32 or float64 depending on weight_engine
+    assert np.allclose(hists['numba'].sumw, hists['awkward'].sumw, rtol=1e-5)
+    assert np.allclose(hists['numba'].sumw2, hists['awkward'].sumw2, rtol=1e-5)
@@ -0,0 +1,72 @@
+"""Local copies of remote files, downloaded again when the remote file changes"""
+
+import os
+import shutil
+
+import filecache
+
+
+def downloads(server):
+    return [request for request in server.requests if request[0] == 'GET']
+
+
+def test_cached_copy_is_reused(http_server, root_file, tmp_path):
+    shutil.copy(root_file, http_server.directory / 'test.root')
+    url = http_server.url + 'test.root'
+    path = filecache.fetch(url, str(tmp_path / 'cache'))
+    assert path != url
+    assert filecache.fetch(url, str(tmp_path / 'cache')) == path
+    assert len(downloads(http_server)) == 1 # the second fetch only asked for the headers
+    with open(path, 'rb') as cached, open(root_file, 'rb') as original:
+        assert cached.read() == original.read()
+
+
+def test_changed_remote_file_is_downloaded_again(http_server, root_file, tmp_path):
+    remote = http_server.directory / 'test.root'
+    shutil.copy(root_file, remote)
+    url = http_server.url + 'test.root'
+    path = filecache.fetch(url, str(tmp_path / 'cache'))
+
+    with open(remote, 'ab') as f: # a new version of the file
+        f.write(b'new version')
+    stat = os.stat(remote)
+    os.utime(remote, (stat.st_atime, stat.st_mtime + 10))
+    assert filecache.fetch(url, str(tmp_path / 'cache')) == path
+    assert len(downloads(http_server)) == 2
+    with open(path, 'rb') as f:
+        assert f.read().endswith(b'new version')
+
+
+def test_cached_copy_is_used_when_the_server_is_down(http_server, root_file, tmp_path):
+    shutil.copy(root_file, http_server.directory / 'test.root')
+    url = http_server.url + 'test.root'
+    path = filecache.fetch(url, str(tmp_path / 'cache'))
+    http_server.shutdown()
+    http_server.server_close()
+    assert filecache.fetch(url, str(tmp_path / 'cache')) == path
+
+
+def test_corrupted_copy_is_not_used_when_the_server_is_down(http_server, root_file, tmp_path):
+    shutil.copy(root_file, http_server.directory / 'test.root')
+    url = http_server.url + 'test.root'
+    path = filecache.fetch(url, str(tmp_path / 'cache'))
+    with open(path, 'r+b') as f: # same size, other bytes
+        f.seek(1000)
+        f.write(b'corrupted')
+    http_server.shutdown()
+    http_server.server_close()
+    assert filecache.fetch(url, str(tmp_path / 'cache')) == url # read remotely, or fail there
+
+
+def test_lock_removed_by_another_worker(http_server, root_file, tmp_path, monkeypatch):
+    shutil.copy(root_file, http_server.directory / 'test.root')
+    url = http_server.url + 'test.root'
+    download = filecache.download
+
+    def slow_download(url, path): # another worker takes the lock for stale and removes it meanwhile
+        os.remove(path + '.lock')
+        return download(url, path)
+
+    monkeypatch.setattr(filecache, 'download', slow_download)
+    path = filecache.fetch(url, str(tmp_path / 'cache'))
+    assert path != url and os.path.exists(path)
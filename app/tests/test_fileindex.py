@@ -0,0 +1,58 @@
+"""Task splitting and cost estimation from the file index"""
+
+import pytest
+
+import fileindex
+from selection import cut_branches, kinematic_branches, weight_branches
+
+
+@pytest.fixture(scope='module')
+def entry(root_file):
+    return fileindex.probe(root_file, cut_branches + kinematic_branches + weight_branches)
+
+
+def check_covers(ranges, num_entries):
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == num_entries
+    for (_, stop), (start, _) in zip(ranges, ranges[1:]): # contiguous
+        assert stop == start
+    assert all(start < stop for start, stop in ranges)
+
+
+@pytest.mark.parametrize('entries_per_task', [300, 500, 1200, 4000, 10000])
+def test_ranges_cover_the_file_on_basket_boundaries(entry, entries_per_task):
+    ranges = fileindex.split_aligned(entry['num_entries'], entries_per_task, entry['common_offsets'])
+    check_covers(ranges, entry['num_entries'])
+    for start, stop in ranges: # a boundary every 500 entries is always within entries_per_task
+        assert start in entry['common_offsets']
+        assert stop in entry['common_offsets']
+        assert stop - start <= 2 * entries_per_task
+
+
+def test_boundary_too_far_on_is_not_used():
+    # only the start and end of the file are shared boundaries, the last task runs on to the end
+    assert fileindex.split_aligned(4000, 1000, [0, 4000]) == [(0, 1000), (1000, 2000), (2000, 4000)]
+    # 1700 is 700 entries past the target 1000 and is used, 4000 is 1300 entries past the target 2700 and is not
+    assert fileindex.split_aligned(4000, 1000, [0, 1700, 4000]) == [(0, 1700), (1700, 2700), (2700, 4000)]
+
+
+@pytest.mark.parametrize('fraction', [0.1, 0.3, 0.55])
+def test_part_of_a_file(entry, fraction):
+    num_entries = int(entry['num_entries'] * fraction) # as the producer does
+    ranges = fileindex.split_aligned(num_entries, 500, entry['common_offsets'])
+    check_covers(ranges, num_entries)
+    assert all(stop in entry['common_offsets'] or stop == num_entries for _, stop in ranges)
+
+
+def test_range_bytes_adds_up_the_baskets(entry, read_branches):
+    total = sum(sum(entry['branches'][name]['basket_bytes']) for name in read_branches)
+    assert fileindex.range_bytes(entry, read_branches, 0, entry['num_entries']) == total
+    ranges = fileindex.split_aligned(entry['num_entries'], 1000, entry['common_offsets'])
+    # ranges on basket boundaries share no basket
+    assert sum(fileindex.range_bytes(entry, read_branches, start, stop) for start, stop in ranges) == total
+    # a range inside one basket costs the whole basket of each branch
+    first = sum(entry['branches'][name]['basket_bytes'][0] for name in read_branches)
+    assert fileindex.range_bytes(entry, read_branches, 10, 20) == first
+    assert fileindex.range_bytes(entry, read_branches, 499, 501) > first
+    # branches without basket details and unknown branches cost nothing
+    assert fileindex.range_bytes(entry, ['runNumber', 'lep_pt'], 0, 500) == entry['branches']['lep_pt']['basket_bytes'][0]
@@ -0,0 +1,73 @@
+"""Histogram shared by the consumers and the outputter"""
+
+import numpy as np
+import pytest
+
+import wire
+from histogram import Histogram
+
+edges = np.arange(80, 255, 5.0) # the binning of the plot in config.toml, in GeV
+
+
+@pytest.fixture
+def values():
+    rng = np.random.default_rng(0)
+    # the last value is on the last edge, which numpy counts in the last bin
+    return np.append(rng.uniform(70, 260, 5000), edges[-1]), rng.normal(1, 0.2, 5001)
+
+
+@pytest.mark.parametrize('bins', [edges, np.array([80, 100, 125, 160, 250.0])])
+def test_fill_matches_numpy(values, bins):
+    x, weights = values
+    counts, _ = np.histogram(x, bins=bins)
+    hist = Histogram(bins).fill(x[:2000]).fill(x[2000:]) # filled batch by batch
+    assert np.array_equal(hist.sumw, counts)
+    assert np.array_equal(hist.sumw2, counts)
+    assert hist.sumw[-1] > 0
+
+    sumw, _ = np.histogram(x, bins=bins, weights=weights)
+    sumw2, _ = np.histogram(x, bins=bins, weights=weights**2)
+    hist = Histogram(bins).fill(x, weights)
+    assert np.allclose(hist.sumw, sumw)
+    assert np.allclose(hist.sumw2, sumw2)
+
+
+def test_adding_is_associative(values):
+    x, weights = values
+    a, b, c = (Histogram(edges).fill(x[i::3], weights[i::3]) for i in range(3))
+    left, right = (a + b) + c, a + (b + c)
+    assert np.allclose(left.sumw, right.sumw)
+    assert np.allclose(left.sumw2, right.sumw2)
+    total = sum([a, b, c])
+    assert np.allclose(total.sumw, Histogram(edges).fill(x, weights).sumw)
+    assert np.array_equal(a.sumw, Histogram(edges).fill(x[0::3], weights[0::3]).sumw) # + does not change a
+
+
+def test_bytes_round_trip_through_a_message(values):
+    x, weights = values
+    hist = Histogram(edges).fill(x, weights)
+    header, data = wire.decode(wire.encode({'sample': 'test', 'histogram': True}, payload=hist.to_bytes()))
+    assert data is None and header['sample'] == 'test'
+    received = Histogram.from_bytes(header['payload'])
+    assert np.array_equal(received.edges, hist.edges)
+    assert np.array_equal(received.sumw, hist.sumw)
+    assert np.array_equal(received.sumw2, hist.sumw2)
+
+
+def test_rebin_sums_adjacent_bins(values):
+    x, weights = values
+    hist = Histogram(edges).fill(x, weights)
+    rebinned = hist.rebin(2)
+    assert np.array_equal(rebinned.edges, edges[::2])
+    assert np.allclose(rebinned.sumw, hist.sumw.reshape(-1, 2).sum(axis=1))
+    assert np.allclose(rebinned.sumw2, hist.sumw2.reshape(-1, 2).sum(axis=1))
+    assert np.isclose(rebinned.sumw.sum(), hist.sumw.sum())
+    with pytest.raises(ValueError):
+        hist.rebin(4) # 34 bins
+
+
+def test_merge_rejects_other_edges():
+    with pytest.raises(ValueError):
+        Histogram(edges).merge(Histogram(edges + 1))
+    with pytest.raises(ValueError):
+        Histogram(edges) + Histogram(edges[::2])
@@ -0,0 +1,107 @@
+"""Byte-range cache under uproot's HTTP source, read from a local server"""
+
+import os
+import shutil
+import time
+
+import awkward as ak
+import pytest
+import uproot
+
+import httpcache
+from conftest import make_root_file
+
+
+@pytest.fixture
+def remote_file(http_server, root_file):
+    shutil.copy(root_file, http_server.directory / 'test.root')
+    return http_server.url + 'test.root'
+
+
+@pytest.fixture
+def tiers(monkeypatch):
+    monkeypatch.setattr(httpcache, 'memory_tier', httpcache.MemoryTier(64e6))
+    monkeypatch.setattr(httpcache, 'disk_tier', None)
+    httpcache.reset_stats()
+
+
+def read(url, branches):
+    httpcache.reset_stats()
+    with uproot.open(url + ':mini', handler=httpcache.CachingHTTPSource) as tree:
+        return tree.arrays(branches, library='ak')
+
+
+def range_requests(server):
+    return [request for request in server.requests if request[1] is not None]
+
+
+def test_second_open_is_served_from_memory(tiers, remote_file, root_file, http_server, read_branches):
+    first = read(remote_file, read_branches)
+    assert httpcache.stats['misses'] > 0
+    assert httpcache.stats['bytes_fetched'] > 0
+    fetched = len(range_requests(http_server))
+
+    second = read(remote_file, read_branches)
+    assert httpcache.stats['misses'] == 0
+    assert httpcache.stats['bytes_fetched'] == 0
+    assert httpcache.stats['memory_hits'] > 0
+    assert len(range_requests(http_server)) == fetched # no byte range was asked for again
+
+    with uproot.open(root_file + ':mini') as tree:
+        expected = tree.arrays(read_branches, library='ak')
+    assert ak.array_equal(first, expected)
+    assert ak.array_equal(second, expected)
+
+
+def test_disk_tier_is_shared_between_processes(tiers, monkeypatch, tmp_path, remote_file, http_server, read_branches):
+    monkeypatch.setattr(httpcache, 'disk_tier', httpcache.DiskTier(str(tmp_path / 'baskets')))
+    first = read(remote_file, read_branches)
+    assert httpcache.stats['bytes_cached'] == httpcache.stats['bytes_fetched'] > 0
+
+    # a new consumer starts with an empty memory tier
+    monkeypatch.setattr(httpcache, 'memory_tier', httpcache.MemoryTier(64e6))
+    second = read(remote_file, read_branches)
+    assert httpcache.stats['misses'] == 0
+    assert httpcache.stats['disk_hits'] > 0
+    assert ak.array_equal(first, second)
+
+
+def test_memory_tier_drops_least_recently_used():
+    tier = httpcache.MemoryTier(10)
+    tier.put(('a', 0, 4), b'aaaa')
+    tier.put(('b', 0, 4), b'bbbb')
+    tier.get(('a', 0, 4)) # a is now the most recently used
+    tier.put(('c', 0, 4), b'cccc')
+    assert tier.get(('b', 0, 4)) is None
+    assert tier.get(('a', 0, 4)) == b'aaaa'
+    assert tier.nbytes == 8
+
+
+def test_replaced_file_is_fetched_again(tiers, monkeypatch, tmp_path, remote_file, http_server, read_branches):
+    monkeypatch.setattr(httpcache, 'disk_tier', httpcache.DiskTier(str(tmp_path / 'baskets')))
+    read(remote_file, read_branches)
+    fetched = len(range_requests(http_server))
+
+    # the server now has another file under the same url
+    new_file = make_root_file(str(tmp_path / 'new.root'), num_entries=3000, seed=1)
+    shutil.copy(new_file, http_server.directory / 'test.root')
+    second = read(remote_file, read_branches)
+    assert httpcache.stats['memory_hits'] == httpcache.stats['disk_hits'] == 0
+    assert httpcache.stats['bytes_fetched'] > 0
+    assert len(range_requests(http_server)) > fetched
+    with uproot.open(new_file + ':mini') as tree:
+        assert ak.array_equal(second, tree.arrays(read_branches, library='ak'))
+
+
+def test_disk_tier_drops_least_recently_used(tmp_path):
+    tier = httpcache.DiskTier(str(tmp_path), max_bytes=10)
+    tier.put(('a', 'v', 0, 4), b'aaaa')
+    tier.put(('b', 'v', 0, 4), b'bbbb')
+    old = time.time() - 60
+    os.utime(tier.path(('a', 'v', 0, 4)), (old, old))
+    os.utime(tier.path(('b', 'v', 0, 4)), (old + 1, old + 1))
+    assert tier.get(('a', 'v', 0, 4)) == b'aaaa' # a is now the most recently used
+    tier.put(('c', 'v', 0, 4), b'cccc')
+    assert tier.get(('b', 'v', 0, 4)) is None
+    assert tier.get(('a', 'v', 0, 4)) == b'aaaa'
+    assert tier.get(('a', 'w', 0, 4)) is None # another version of the file
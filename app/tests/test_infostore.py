@@ -0,0 +1,20 @@
+"""Metadata table generated from infofile.py"""
+
+import infofile
+import infostore
+
+
+def test_table_matches_infofile():
+    infos = infostore.InfoStore(infostore.table_path) # read the table again
+    # run "python infostore.py" in the app folder after changing infofile.py
+    assert list(infos) == list(infofile.infos)
+    for name, info in infofile.infos.items():
+        assert infos[name] == info, name
+        assert all(type(infos[name][k]) is type(v) for k, v in info.items()), name
+
+
+def test_names_of_a_dsid():
+    for name, info in infofile.infos.items():
+        assert name in infostore.dsid_names(info['DSID'])
+    unknown = max(info['DSID'] for info in infofile.infos.values()) + 1
+    assert infostore.dsid_names(unknown) == []
@@ -0,0 +1,213 @@
+"""Merging of the consumers' messages in the outputter"""
+
+import json
+import time
+import tracemalloc
+
+import awkward as ak
+import numpy as np
+import pytest
+
+import output
+import wire
+
+
+@pytest.fixture(autouse=True)
+def empty_outputter(monkeypatch):
+    output.reset_run()
+    monkeypatch.setattr(output, 'manifest', None)
+    monkeypatch.setattr(output, 'superseded_runs', set())
+    monkeypatch.setattr(output, 'held_messages', [])
+    yield
+    output.reset_run()
+
+
+### Channel recording what the outputter acknowledges
+class Channel:
+    def __init__(self):
+        self.acked = []
+        self.stopped = False
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def stop_consuming(self):
+        self.stopped = True
+
+
+class Method:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+def send_manifest(channel, run_id, created, task_ids):
+    manifest = {'run_id': run_id, 'created': created, 'task_ids': task_ids, 'num_tasks': len(task_ids)}
+    output.manifest_callback(channel, Method(0), None, json.dumps(manifest).encode('utf-8'))
+
+
+def send_result(channel, delivery_tag, run_id, created, task_id, data):
+    header = {'sample': 'data_A', 'run_id': run_id, 'run_created': created, 'task_id': task_id,
+              'seq': 0, 'end_of_task': True}
+    output.callback(channel, Method(delivery_tag), None, wire.encode(header, data))
+
+
+def messages(num_messages, num_events=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    return [ak.zip({'mllll': rng.uniform(80, 250, num_events), 'totalWeight': rng.normal(1, 0.1, num_events)})
+            for _ in range(num_messages)]
+
+
+### Merge the messages and concatenate them, returning the time taken and the peak memory allocated
+def merge(arrays):
+    output.merged_data.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for data in arrays:
+        output.process_segment({'sample': 'data_A', 'data': data})
+    merged = output.snapshot(output.merged_data)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return merged, elapsed, peak
+
+
+def test_files_of_a_sample_are_merged():
+    first, second = messages(2)
+    output.process_segment({'sample': 'data_A', 'data': first})
+    output.process_segment({'sample': 'data_B', 'data': second})
+    merged = output.snapshot(output.merged_data)
+    assert list(merged) == ['data']
+    assert ak.array_equal(merged['data'], ak.concatenate([first, second]))
+
+
+def test_messages_are_only_concatenated_by_snapshot(monkeypatch):
+    calls = []
+    concatenate = ak.concatenate
+    monkeypatch.setattr(ak, 'concatenate', lambda arrays, *args, **kwargs: calls.append(len(arrays))
+                        or concatenate(arrays, *args, **kwargs))
+    for data in messages(50):
+        output.process_segment({'sample': 'data_A', 'data': data})
+    assert calls == []
+    output.snapshot(output.merged_data)
+    assert calls == [50] # every array is copied once
+    output.snapshot(output.merged_data)
+    assert calls == [50] # already concatenated
+
+
+def test_time_and_memory_grow_linearly():
+    small, large = messages(100), messages(400)
+    merge(small) # warm up
+    results = {}
+    for name, arrays in [('small', small), ('large', large)]:
+        runs = [merge(arrays) for _ in range(3)]
+        results[name] = (min(run[1] for run in runs), min(run[2] for run in runs))
+        assert len(runs[0][0]['data']) == sum(len(data) for data in arrays)
+    # 4 times the messages, concatenating on every message would take about 16 times as long
+    assert results['large'][0] / results['small'][0] < 8
+    assert results['large'][1] / results['small'][1] < 6
+
+
+def test_messages_before_the_manifest_are_held():
+    channel = Channel()
+    data, = messages(1)
+    send_result(channel, 1, 'run', 100.0, 'data_A:0-10', data)
+    assert channel.acked == [] and output.merged_data == {}
+    send_manifest(channel, 'run', 100.0, ['data_A:0-10'])
+    assert channel.acked == [0, 1]
+    assert output.completed_tasks == {'data_A:0-10'}
+    assert channel.stopped
+
+
+def test_results_left_by_an_earlier_run_are_dropped():
+    channel = Channel()
+    old, new = messages(2)
+    send_result(channel, 1, 'old', 50.0, 'data_A:0-10', old) # the same task id in every run
+    send_manifest(channel, 'new', 100.0, ['data_A:0-10'])
+    assert 1 in channel.acked
+    assert output.completed_tasks == set()
+    send_result(channel, 2, 'new', 100.0, 'data_A:0-10', new)
+    assert output.completed_tasks == {'data_A:0-10'}
+    assert ak.array_equal(output.snapshot(output.merged_data)['data'], new)
+
+
+def test_later_manifest_replaces_a_stale_one():
+    channel = Channel()
+    stale, new = messages(2)
+    send_manifest(channel, 'stale', 50.0, ['data_A:0-10', 'data_A:10-20'])
+    send_result(channel, 1, 'stale', 50.0, 'data_A:0-10', stale)
+    send_result(channel, 2, 'new', 100.0, 'data_A:0-10', new)
+    assert 2 not in channel.acked # its run is not known yet
+    send_manifest(channel, 'new', 100.0, ['data_A:0-10'])
+    assert output.manifest['run_id'] == 'new'
+    assert output.completed_tasks == {'data_A:0-10'}
+    assert ak.array_equal(output.snapshot(output.merged_data)['data'], new)
+    assert channel.stopped
+
+
+def test_earlier_manifest_is_ignored():
+    channel = Channel()
+    data, = messages(1)
+    send_manifest(channel, 'new', 100.0, ['data_A:0-10', 'data_A:10-20'])
+    send_result(channel, 1, 'new', 100.0, 'data_A:0-10', data)
+    send_manifest(channel, 'stale', 50.0, ['data_A:0-10'])
+    assert output.manifest['run_id'] == 'new'
+    assert output.completed_tasks == {'data_A:0-10'}
+    send_result(channel, 2, 'stale', 50.0, 'data_A:10-20', data)
+    assert 2 in channel.acked
+    assert output.missing_tasks() == ['data_A:10-20']
+
+
+def send_batch(channel, delivery_tag, task_id, attempt, seq, data, end_of_task=False):
+    header = {'sample': 'data_A', 'run_id': 'run', 'run_created': 100.0, 'task_id': task_id,
+              'attempt': attempt, 'seq': seq, 'end_of_task': end_of_task}
+    output.callback(channel, Method(delivery_tag), None, wire.encode(header, data))
+
+
+def test_retried_task_with_other_batches_is_counted_once():
+    channel = Channel()
+    send_manifest(channel, 'run', 100.0, ['data_A:0-30'])
+    events, = messages(1, num_events=30)
+    # the first attempt streams two batches of 10 events and fails
+    send_batch(channel, 1, 'data_A:0-30', 1.0, 0, events[:10])
+    send_batch(channel, 2, 'data_A:0-30', 1.0, 1, events[10:20])
+    # the retry reads batches of 15 events, so its sequence numbers cover other events
+    send_batch(channel, 3, 'data_A:0-30', 2.0, 0, events[:15])
+    send_batch(channel, 4, 'data_A:0-30', 1.0, 2, events[20:25]) # late message of the first attempt
+    send_batch(channel, 5, 'data_A:0-30', 2.0, 1, events[15:])
+    assert output.completed_tasks == set()
+    send_batch(channel, 6, 'data_A:0-30', 2.0, 2, None, end_of_task=True)
+    assert output.completed_tasks == {'data_A:0-30'}
+    assert channel.acked == [0, 1, 2, 3, 4, 5, 6]
+    assert ak.array_equal(output.snapshot(output.merged_data)['data'], events)
+
+
+def test_batches_of_a_task_arrive_out_of_order():
+    channel = Channel()
+    send_manifest(channel, 'run', 100.0, ['data_A:0-30'])
+    events, = messages(1, num_events=30)
+    send_batch(channel, 1, 'data_A:0-30', 1.0, 2, None, end_of_task=True)
+    send_batch(channel, 2, 'data_A:0-30', 1.0, 1, events[15:])
+    send_batch(channel, 3, 'data_A:0-30', 1.0, 1, events[15:]) # sent again
+    assert output.completed_tasks == set()
+    send_batch(channel, 4, 'data_A:0-30', 1.0, 0, events[:15])
+    assert output.completed_tasks == {'data_A:0-30'}
+    assert len(output.snapshot(output.merged_data)['data']) == 30
+
+
+def test_ledger_keeps_the_messages_of_the_latest_attempt(monkeypatch, tmp_path):
+    monkeypatch.setattr(output.ledger, 'ledger_dir', str(tmp_path))
+    monkeypatch.setattr(output.ledger, 'enabled', True)
+    monkeypatch.setattr(output, 'run_ledger', {})
+    channel = Channel()
+    send_manifest(channel, 'run', 100.0, ['data_A:0-30'])
+    events, = messages(1, num_events=30)
+    header = {'sample': 'data_A', 'run_id': 'run', 'run_created': 100.0, 'task_id': 'data_A:0-30',
+              'fingerprint': 'abc'}
+    for delivery_tag, attempt, seq, data, end in [(1, 1.0, 0, events[:10], False), (2, 2.0, 0, events, False),
+                                                  (3, 2.0, 1, None, True)]:
+        body = wire.encode(dict(header, attempt=attempt, seq=seq, end_of_task=end), data)
+        output.callback(channel, Method(delivery_tag), None, body)
+    assert output.run_ledger['data_A:0-30']['fingerprint'] == 'abc'
+    kept = [wire.decode(body) for body in output.ledger.read_result('abc')]
+    assert [h['attempt'] for h, _ in kept] == [2.0, 2.0]
+    assert ak.array_equal(kept[0][1], events)
@@ -0,0 +1,43 @@
+"""Hashes of the selection, the consumer code and the configuration"""
+
+import shutil
+
+import config
+import selection
+
+
+def test_code_files_are_found():
+    for name in selection.result_code:
+        assert selection.code_path(name)
+
+
+def test_code_hash_changes_with_the_consumer_code(tmp_path, monkeypatch):
+    for name in selection.result_code:
+        shutil.copy(selection.code_path(name), tmp_path / name)
+    monkeypatch.setattr(selection, 'code_dirs', [str(tmp_path)])
+    before = selection.code_hash(selection.result_code)
+    skim_before = selection.selection_hash(config.settings)
+    with open(tmp_path / 'consumer.py', 'a') as f:
+        f.write('\n# a change to the mass calculation\n')
+    assert selection.code_hash(selection.result_code) != before
+    assert selection.selection_hash(config.settings) != skim_before
+
+
+def test_skims_do_not_depend_on_the_event_loop(tmp_path, monkeypatch):
+    for name in selection.result_code:
+        shutil.copy(selection.code_path(name), tmp_path / name)
+    monkeypatch.setattr(selection, 'code_dirs', [str(tmp_path)])
+    skim_before = selection.selection_hash(config.settings)
+    with open(tmp_path / 'fastloop.py', 'a') as f:
+        f.write('\n# a change to the numba engine\n')
+    assert selection.selection_hash(config.settings) == skim_before
+
+
+def test_config_hash_covers_the_engines_only():
+    settings = config.load()
+    before = config.config_hash(settings)
+    settings['consumer']['iterate_step'] = 1000 # changes how the events are read, not the results
+    assert config.config_hash(settings) == before
+    settings['consumer']['weight_engine'] = 'awkward' if settings['consumer']['weight_engine'] == 'numpy' else 'numpy'
+    assert config.config_hash(settings) != before
+    assert selection.selection_hash(settings) != selection.selection_hash(config.load())
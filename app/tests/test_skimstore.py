@@ -0,0 +1,74 @@
+"""Parquet skims written batch by batch"""
+
+import os
+
+import awkward as ak
+import numpy as np
+import pytest
+
+import skimstore
+
+
+@pytest.fixture(autouse=True)
+def skim_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(skimstore, 'skim_dir', str(tmp_path / 'skims'))
+    monkeypatch.setattr(skimstore, 'enabled', True)
+    return tmp_path / 'skims'
+
+
+source = skimstore.source_id('http://server/test.root', {'size': 100, 'etag': '"1"', 'last_modified': None})
+
+
+def batches(num_batches, seed=0):
+    rng = np.random.default_rng(seed)
+    return [ak.zip({'lep_pt': ak.unflatten(rng.uniform(0, 1, 40).astype(np.float32), 4),
+                    'mllll': rng.uniform(80, 250, 10)}, depth_limit=1) for _ in range(num_batches)]
+
+
+def test_batches_are_written_to_one_skim():
+    arrays = batches(3)
+    with skimstore.Writer('selection', 'test', 0, 100, source) as skim:
+        for array in arrays:
+            skim.write(array)
+        assert not skimstore.exists('selection', 'test', 0, 100, source) # only renamed into place at the end
+    assert skimstore.exists('selection', 'test', 0, 100, source)
+    assert ak.array_equal(skimstore.read('selection', 'test', 0, 100, source), ak.concatenate(arrays))
+
+
+def test_skim_without_events_is_empty():
+    with skimstore.Writer('selection', 'test', 0, 100, source):
+        pass
+    assert len(skimstore.read('selection', 'test', 0, 100, source)) == 0
+
+
+def test_skim_of_a_failed_task_is_dropped(skim_dir):
+    with pytest.raises(RuntimeError):
+        with skimstore.Writer('selection', 'test', 0, 100, source) as skim:
+            skim.write(batches(1)[0])
+            raise RuntimeError('task failed')
+    assert not skimstore.exists('selection', 'test', 0, 100, source)
+    assert os.listdir(skim_dir / 'selection') == [] # no temporary file left
+
+
+def test_disabled_writer_writes_nothing(skim_dir):
+    with skimstore.Writer('selection', 'test', 0, 100, source, enabled=False) as skim:
+        skim.write(batches(1)[0])
+    assert not skim_dir.exists()
+
+
+def test_skim_of_another_version_of_the_file_is_not_used():
+    with skimstore.Writer('selection', 'test', 0, 100, source) as skim:
+        skim.write(batches(1)[0])
+    changed = skimstore.source_id('http://server/test.root', {'size': 100, 'etag': '"2"', 'last_modified': None})
+    moved = skimstore.source_id('http://other/test.root', {'size': 100, 'etag': '"1"', 'last_modified': None})
+    assert skimstore.exists('selection', 'test', 0, 100, source)
+    assert not skimstore.exists('selection', 'test', 0, 100, changed)
+    assert not skimstore.exists('selection', 'test', 0, 100, moved)
+
+
+def test_no_skim_without_the_file_version(skim_dir):
+    assert skimstore.source_id('http://server/test.root', None) is None
+    with skimstore.Writer('selection', 'test', 0, 100, None) as skim:
+        skim.write(batches(1)[0])
+    assert not skim_dir.exists()
+    assert not skimstore.exists('selection', 'test', 0, 100, None)
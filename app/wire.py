@@ -0,0 +1,105 @@
+"""Columnar binary message format for sending awkward arrays between the services
+
+A message is a 4-byte header length, a JSON header (sample name, awkward form, number of
+entries and the size of each buffer) and then the buffers from ak.to_buffers, each
+compressed separately with zlib unless that does not make it smaller. A message can also end
+with an opaque payload, e.g. a serialised histogram.
+"""
+
+import json
+import struct
+import zlib
+
+import awkward as ak
+import numpy as np
+
+# zlib compression level of the buffers, 1 is much faster than the default and nearly as small
+compression_level = 1
+
+
+### Encode a header dictionary and an optional awkward array or bytes payload into a message
+def encode(header, array=None, payload=None):
+    header = dict(header)
+    buffers = []
+    if array is not None:
+        form, length, container = ak.to_buffers(ak.to_packed(array)) # drop data removed by cuts
+        header['form'] = form.to_json()
+        header['length'] = length
+        header['buffers'] = []
+        for key, buffer in container.items():
+            raw = np.ascontiguousarray(buffer).view(np.uint8).data
+            compressed = zlib.compress(raw, compression_level)
+            if len(compressed) < len(raw):
+                header['buffers'].append([key, len(compressed), True])
+                buffers.append(compressed)
+            else: # not worth compressing, sent as it is
+                header['buffers'].append([key, len(raw), False])
+                buffers.append(raw)
+    if payload is not None:
+        header['payload'] = len(payload)
+        buffers.append(payload)
+    head = json.dumps(header).encode('utf-8')
+    return b''.join([struct.pack('<I', len(head)), head] + buffers)
+
+
+### Decode a message into its header and awkward array (None if the message has no array)
+# uncompressed buffers are used in place, without copying them out of the message
+# a payload is returned as header['payload']
+def decode(body):
+    view = memoryview(body)
+    (head_length,) = struct.unpack_from('<I', view)
+    position = 4 + head_length
+    header = json.loads(bytes(view[4:position]).decode('utf-8'))
+    if 'payload' in header:
+        header['payload'] = view[len(view) - header['payload']:]
+    if 'form' not in header:
+        return header, None
+    container = {}
+    for key, size, compressed in header.pop('buffers'):
+        buffer = view[position:position + size]
+        position += size
+        container[key] = np.frombuffer(zlib.decompress(buffer) if compressed else buffer, dtype=np.uint8)
+    array = ak.from_buffers(ak.forms.from_json(header.pop('form')), header.pop('length'), container)
+    return header, array
+
+
+### Encode with the previous format: python lists, JSON and zlib
+def encode_json(header, array):
+    return zlib.compress(json.dumps(dict(header, data=ak.to_list(array))).encode('utf-8'))
+
+
+### Decode the previous format
+def decode_json(body):
+    header = json.loads(zlib.decompress(body).decode('utf-8'))
+    return header, ak.Array(header.pop('data'))
+
+
+### Compare message size and encode/decode time of the two formats
+def benchmark(num_events=200000, repeats=3):
+    import time
+    rng = np.random.default_rng(42)
+    counts = rng.integers(4, 7, num_events) # 4lep events have at least 4 leptons
+    total = int(counts.sum())
+    leptons = {name: ak.unflatten(rng.normal(50, 20, total).astype(np.float32), counts)
+               for name in ['lep_pt', 'lep_eta', 'lep_phi', 'lep_E']}
+    leptons['lep_charge'] = ak.unflatten(rng.choice(np.array([-1, 1], np.int32), total), counts)
+    leptons['lep_type'] = ak.unflatten(rng.choice(np.array([11, 13], np.uint32), total), counts)
+    events = ak.zip(leptons, depth_limit=1)
+    events['totalWeight'] = rng.normal(1e-3, 1e-4, num_events)
+    events['mllll'] = rng.normal(125, 30, num_events)
+
+    for name, enc, dec in [('json+zlib', encode_json, decode_json), ('columnar', encode, decode)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            body = enc({'sample': 'benchmark'}, events)
+        encode_time = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        for _ in range(repeats):
+            _, decoded = dec(body)
+        decode_time = (time.perf_counter() - start) / repeats
+        assert ak.all(decoded.mllll == events.mllll) # both formats are lossless
+        print(f'{name:>10}: {len(body)/1e6:8.2f} MB, encode {encode_time:7.3f} s, decode {decode_time:7.3f} s')
+
+
+if __name__ == '__main__':
+    benchmark()